@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from .models import AlphaVantageCurrencySource, MorningstarDataSource, InterpolatedDataSource
-from .models import ConstantDataSource, PandasDataSource, AlphaVantageStockSource
+from .models import ConstantDataSource, PandasDataSource, AlphaVantageStockSource, DataSourceCoverage
 
 
 class ConstantDataSourceAdmin(admin.ModelAdmin):
@@ -29,3 +29,8 @@ class InterpolatedDataSourceAdmin(admin.ModelAdmin):
 admin.site.register(InterpolatedDataSource, InterpolatedDataSourceAdmin)
 
 
+
+class DataSourceCoverageAdmin(admin.ModelAdmin):
+    list_display = ['datasource', 'security', 'start', 'end', 'empty_attempts', 'last_fetched']
+    list_filter = ['security']
+admin.site.register(DataSourceCoverage, DataSourceCoverageAdmin)
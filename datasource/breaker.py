@@ -0,0 +1,167 @@
+"""
+A circuit breaker per provider, shared by every process through the default Redis cache.
+
+Usage:
+    @guarded
+    def _Query(self, start, end):
+        ...
+
+While a provider's breaker is closed, calls go through and their latency and outcome are recorded.
+Once too many of the recent calls have failed it opens, and calls raise CircuitOpen straight away
+without touching the network. After OPEN_SECONDS it is half-open: a single trial call is let through,
+which closes the breaker if it succeeds and opens it again if it fails.
+
+A failure is a SourceError or a requests exception. A provider that answers with no data is fine.
+Guard a throttled method from outside the throttle, so an open circuit fails fast without taking
+a token. The latency recorded leaves out the time spent waiting for one.
+"""
+import functools
+import time
+
+import requests
+from django_redis import get_redis_connection
+
+from .throttle import Throttled, time_waiting
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+# Open once at least ERROR_RATE of the last WINDOW calls failed, counting only after MIN_CALLS calls.
+WINDOW = 20
+MIN_CALLS = 5
+ERROR_RATE = 0.5
+OPEN_SECONDS = 5 * 60
+
+
+class SourceError(Exception):
+    """ A provider failed to answer, as opposed to having no data for us."""
+
+
+class CircuitOpen(SourceError):
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __str__(self):
+        return 'Circuit for {} is open'.format(self.provider)
+
+
+class CircuitBreaker:
+    def __init__(self, provider):
+        self.provider = provider
+        self.key = 'breaker:{}'.format(provider)
+        self.outcomes_key = '{}:outcomes'.format(self.key)
+        self.latency_key = '{}:latency'.format(self.key)
+        self.trial_key = '{}:trial'.format(self.key)
+
+    def __repr__(self):
+        return 'CircuitBreaker<{}>'.format(self.provider)
+
+    @property
+    def redis(self):
+        return get_redis_connection('default')
+
+    @property
+    def state(self):
+        opened_at = self.redis.hget(self.key, 'opened_at')
+        if opened_at is None:
+            return CLOSED
+        if time.time() - float(opened_at) < OPEN_SECONDS:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self):
+        """
+        :return: True if a call may go through now.
+        """
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN:
+            # Only one trial call at a time.
+            return bool(self.redis.set(self.trial_key, 1, nx=True, ex=OPEN_SECONDS))
+        return False
+
+    def record(self, ok, seconds):
+        with self.redis.pipeline() as pipe:
+            pipe.lpush(self.outcomes_key, int(ok))
+            pipe.ltrim(self.outcomes_key, 0, WINDOW - 1)
+            pipe.lpush(self.latency_key, seconds)
+            pipe.ltrim(self.latency_key, 0, WINDOW - 1)
+            pipe.hincrby(self.key, 'calls', 1)
+            pipe.hincrby(self.key, 'errors', 0 if ok else 1)
+            pipe.lrange(self.outcomes_key, 0, -1)
+            outcomes = pipe.execute()[-1]
+
+        state = self.state
+        if state == HALF_OPEN:
+            self.release_trial()
+            if ok:
+                self.close()
+            else:
+                self.open()
+        elif state == CLOSED and not ok:
+            failures = outcomes.count(b'0')
+            if len(outcomes) >= MIN_CALLS and failures / len(outcomes) >= ERROR_RATE:
+                self.open()
+
+    def release_trial(self):
+        self.redis.delete(self.trial_key)
+
+    def open(self):
+        print('Opening circuit for {} for {}s'.format(self.provider, OPEN_SECONDS))
+        self.redis.hset(self.key, 'opened_at', time.time())
+
+    def close(self):
+        print('Closing circuit for {}'.format(self.provider))
+        with self.redis.pipeline() as pipe:
+            pipe.hdel(self.key, 'opened_at')
+            pipe.delete(self.outcomes_key)
+            pipe.execute()
+
+    def stats(self):
+        """
+        :return: A dict of the state, total calls and errors, and the error rate and latency of recent calls.
+        """
+        with self.redis.pipeline() as pipe:
+            pipe.hmget(self.key, 'calls', 'errors')
+            pipe.lrange(self.outcomes_key, 0, -1)
+            pipe.lrange(self.latency_key, 0, -1)
+            (calls, errors), outcomes, latencies = pipe.execute()
+        latencies = [float(l) for l in latencies]
+        return {
+            'state': self.state,
+            'calls': int(calls or 0),
+            'errors': int(errors or 0),
+            'error_rate': outcomes.count(b'0') / len(outcomes) if outcomes else 0,
+            'mean_latency': sum(latencies) / len(latencies) if latencies else 0,
+            'max_latency': max(latencies, default=0),
+        }
+
+
+def guarded(fn):
+    """ Runs a datasource method through the breaker of the datasource's provider."""
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        breaker = CircuitBreaker(self.provider)
+        if not breaker.allow():
+            raise CircuitOpen(self.provider)
+
+        # Time spent waiting on the provider's throttle isn't the provider being slow.
+        start, waited = time.perf_counter(), time_waiting()
+
+        def elapsed():
+            return time.perf_counter() - start - (time_waiting() - waited)
+
+        try:
+            result = fn(self, *args, **kwargs)
+        except Throttled:
+            # We never got to ask, so this doesn't count either way.
+            breaker.release_trial()
+            raise
+        except (SourceError, requests.RequestException) as e:
+            breaker.record(False, elapsed())
+            if isinstance(e, SourceError):
+                raise
+            raise SourceError('{} request failed: {!r}'.format(self.provider, e)) from e
+        breaker.record(True, elapsed())
+        return result
+    return wrapper
@@ -0,0 +1,52 @@
+"""
+A cache of raw provider responses, so syncing a range we already downloaded doesn't hit the network.
+
+Usage:
+    json = cached_response(self.provider, self.symbol, start, end, lambda: self._Query(start, end))
+
+Responses live in the 'datasource' cache (see settings.CACHES), keyed by provider, symbol and the
+requested range. A range ending today can still change, so it expires quickly; historical ranges
+are kept for much longer. A provider answering that it has no data makes fetch return None, which
+is cached for EMPTY_TTL so we don't spend rate limit asking again right away. Failed requests
+raise out of fetch and are never cached. Responses bigger than MAX_RESPONSE_BYTES aren't stored,
+and the backend culls old entries once it is full.
+"""
+import hashlib
+import pickle
+from datetime import date
+
+from django.core.cache import caches
+
+RECENT_TTL = 15 * 60
+HISTORICAL_TTL = 7 * 24 * 60 * 60
+EMPTY_TTL = 60 * 60
+MAX_RESPONSE_BYTES = 4 * 1024 * 1024
+
+_MISSING = object()
+
+
+def response_key(provider, symbol, start, end):
+    raw = '{}:{}:{}:{}'.format(provider, symbol, start, end)
+    return 'response:{}'.format(hashlib.sha1(raw.encode()).hexdigest())
+
+
+def response_ttl(response, end):
+    ttl = RECENT_TTL if end >= date.today() else HISTORICAL_TTL
+    return ttl if response is not None else min(ttl, EMPTY_TTL)
+
+
+def cached_response(provider, symbol, start, end, fetch):
+    """
+    :param fetch: Called with no arguments on a miss. Returns the raw response, or None if the provider has no data.
+    :return: The raw response, from the cache if we have it.
+    """
+    cache = caches['datasource']
+    key = response_key(provider, symbol, start, end)
+    response = cache.get(key, _MISSING)
+    if response is not _MISSING:
+        return response
+
+    response = fetch()
+    if len(pickle.dumps(response)) <= MAX_RESPONSE_BYTES:
+        cache.set(key, response, response_ttl(response, end))
+    return response
@@ -0,0 +1,46 @@
+"""
+Compares fetching Bank of Canada exchange rates one currency at a time against one bulk request.
+
+Usage: manage.py benchmark_fx_fetch [--days 30] [--currencies USD EUR GBP ...]
+
+Talks to the Bank of Canada but skips the response cache, and writes nothing.
+"""
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+
+from datasource.models import PandasDataSource
+
+
+class Command(BaseCommand):
+    help = 'Benchmark one Bank of Canada request per currency against one request for all of them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30)
+        parser.add_argument('--currencies', nargs='+', default=None)
+
+    def handle(self, *args, **options):
+        if options['currencies']:
+            sources = [PandasDataSource(symbol='FXCAD{}'.format(c), source='bankofcanada', column='FXCAD{}'.format(c))
+                       for c in options['currencies']]
+        else:
+            sources = list(PandasDataSource.objects.filter(source='bankofcanada'))
+        end = datetime.date.today()
+        start = end - datetime.timedelta(days=options['days'])
+
+        began = time.perf_counter()
+        one_at_a_time = {s.symbol: s._Series(s._Query(start, end)) for s in sources}
+        single = time.perf_counter() - began
+
+        symbols = ','.join(sorted({s.symbol for s in sources}))
+        began = time.perf_counter()
+        df = sources[0]._Query(start, end, symbols)
+        bulk = {s.symbol: s._Series(df) for s in sources}
+        combined = time.perf_counter() - began
+
+        self.stdout.write('Fetching {} currencies over {} days:'.format(len(sources), options['days']))
+        self.stdout.write('{:>14}: {:8.3f}s {:4} requests'.format('one at a time', single, len(sources)))
+        self.stdout.write('{:>14}: {:8.3f}s {:4} requests'.format('bulk', combined, 1))
+        mismatched = [symbol for symbol, series in one_at_a_time.items() if not series.equals(bulk[symbol])]
+        self.stdout.write('Series that differ: {}'.format(', '.join(mismatched) or 'none'))
@@ -0,0 +1,56 @@
+"""
+Compares the NumPy priority merge of datasource series against the old DataFrame.update merge.
+
+Usage: manage.py benchmark_source_merge [--sources 10] [--years 20] [--repeat 3]
+
+Pure in-memory, no database or network access.
+"""
+import datetime
+import time
+from decimal import Decimal
+
+import numpy
+import pandas
+from django.core.management.base import BaseCommand
+
+from datasource.services import merge_by_priority, merge_by_update
+
+
+class Command(BaseCommand):
+    help = 'Benchmark merge_by_priority against merge_by_update.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sources', type=int, default=10)
+        parser.add_argument('--years', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def make_series(self, start, end, coverage):
+        """ A series of Decimal prices on a random `coverage` fraction of the days."""
+        days = pandas.date_range(start, end, freq='D').date
+        days = days[numpy.random.random(len(days)) < coverage]
+        prices = numpy.round(numpy.random.uniform(10, 100, len(days)), 6)
+        return pandas.Series([Decimal(str(p)) for p in prices], index=days)
+
+    def time(self, fn, retrieved, start, end, repeat):
+        best = None
+        for _ in range(repeat):
+            began = time.perf_counter()
+            result = fn(retrieved, start, end)
+            elapsed = time.perf_counter() - began
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    def handle(self, *args, **options):
+        end = datetime.date.today()
+        start = end - datetime.timedelta(days=365 * options['years'])
+        retrieved = [(priority, self.make_series(start, end, coverage=0.7))
+                     for priority in range(options['sources'])]
+
+        self.stdout.write('Merging {} sources over {} days:'.format(len(retrieved), (end - start).days + 1))
+        results = {}
+        for name, fn in [('update', merge_by_update), ('numpy', merge_by_priority)]:
+            elapsed, results[name] = self.time(fn, retrieved, start, end, options['repeat'])
+            self.stdout.write('{:>8}: {:8.3f}s'.format(name, elapsed))
+
+        mismatched = (results['numpy'].price.astype(float) - results['update'].price).abs().gt(1e-6).sum()
+        self.stdout.write('{} days differ between the two merges.'.format(mismatched))
@@ -0,0 +1,31 @@
+# Generated by Django 2.0.2 on 2026-10-18 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securities', '0011_auto_20180728_2307'),
+        ('datasource', '0005_auto_20180225_1703'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataSourceCoverage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateField()),
+                ('end', models.DateField()),
+                ('empty_attempts', models.IntegerField(default=0)),
+                ('last_fetched', models.DateTimeField(auto_now=True)),
+                ('datasource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coverage', to='datasource.DataSourceMixin')),
+                ('security', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coverage', to='securities.Security')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='datasourcecoverage',
+            index_together={('datasource', 'security')},
+        ),
+    ]
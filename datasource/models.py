@@ -5,12 +5,23 @@ import pandas
 import requests
 from dateutil import parser
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
 from pandas_datareader import data as pdr
 from pandas_datareader.exceptions import UnstableAPIWarning
 from polymorphic.models import PolymorphicModel
 from polymorphic.showfields import ShowFieldTypeAndContent
-from ratelimit import rate_limited
+
+from .breaker import SourceError, guarded
+from .cache import EMPTY_TTL, cached_response
+from .throttle import throttled
+
+# Seconds to wait for a provider to answer, so one hung provider can't stall a sync.
+REQUEST_TIMEOUT = 30
+
+# Every AlphaVantage call counts against the same per-key quota, so stocks and currencies share a bucket.
+alphavantage_throttle = throttled('alphavantage', calls=1, period=15)
 
 
 class DataSourceMixin(ShowFieldTypeAndContent, PolymorphicModel):
@@ -23,12 +34,25 @@ class DataSourceMixin(ShowFieldTypeAndContent, PolymorphicModel):
     PRIORITY_LOW = 10
     priority = models.IntegerField(default=PRIORITY_DAILY)
 
+    # The remote service this source talks to. Sources with the same provider share its
+    # rate limits, so they are synced serially. Empty for sources that don't hit the network.
+    provider = ''
+
     @classmethod
     def is_higher_priority(cls, old, new):
         if new == cls.PRIORITY_REALTIME:
             return True
         return new >= old
 
+    @classmethod
+    def RetrieveMany(cls, sources, start, end):
+        """
+        Retrieves many sources of this type at once, where the provider allows it.
+        Sources left out of the result are retrieved one at a time with _Retrieve as usual.
+        :return: A dict of source pk -> pandas.Series
+        """
+        return {}
+
     def _Retrieve(self, start, end):
         """
         Given datetime.date 'start' and 'end', return a pandas series of price values.
@@ -54,6 +78,10 @@ class PandasDataSource(DataSourceMixin):
     source = models.CharField(max_length=32, default=None)
     column = models.CharField(max_length=32, default=None)
 
+    @property
+    def provider(self):
+        return self.source
+
     @classmethod
     def create_bankofcanada(cls, currency_code):
         symbol = "FXCAD{}".format(currency_code)
@@ -70,23 +98,48 @@ class PandasDataSource(DataSourceMixin):
     def __repr__(self):
         return "PandasDataSource<{},{},{},{}>".format(self.symbol, self.source, self.column, self.priority)
 
+    @classmethod
+    def RetrieveMany(cls, sources, start, end):
+        """
+        Retrieves many Bank of Canada series in one request, since the valet API takes
+        a comma separated list of series names.
+        :return: A dict of source pk -> pandas.Series
+        """
+        sources = [s for s in sources if s.source == 'bankofcanada']
+        if not sources:
+            return {}
+        symbols = ','.join(sorted({s.symbol for s in sources}))
+        df = cached_response('bankofcanada', symbols, start, end, lambda: sources[0]._Query(start, end, symbols))
+        return {source.pk: source._Series(df) for source in sources}
+
     def _Retrieve(self, start, end):
+        df = cached_response(self.provider, self.symbol, start, end, lambda: self._Query(start, end))
+        return self._Series(df)
+
+    def _Series(self, df):
+        if df is None or self.column not in df:
+            return pandas.Series()
+        return pandas.Series(df[self.column], df.index)
+
+    @guarded
+    def _Query(self, start, end, symbol=None):
         import warnings
+        symbol = symbol or self.symbol
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', category=UnstableAPIWarning, lineno=40)
             try:
-                df = pdr.DataReader(self.symbol, self.source, start, end)
-            except:
-                return pandas.Series()
-        if df.empty or self.column not in df:
-            return pandas.Series()
-        return pandas.Series(df[self.column], df.index)
+                df = pdr.DataReader(symbol, self.source, start, end)
+            except Exception as e:
+                raise SourceError('{} failed for {}: {!r}'.format(self.source, symbol, e)) from e
+        return None if df.empty else df
 
 
 class AlphaVantageStockSource(DataSourceMixin):
     api_key = models.CharField(max_length=32, default=settings.ALPHAVANTAGE_KEY)
     symbol = models.CharField(max_length=32)
 
+    provider = 'alphavantage'
+
     def __str__(self):
         return "AlphaVantageStock source for {} ({})".format(self.symbol, self.priority)
 
@@ -100,29 +153,42 @@ class AlphaVantageStockSource(DataSourceMixin):
 
         for symbol in possible_symbols:
             self.symbol = symbol
-            if not self._Retrieve(date.today() - timedelta(days=7), date.today()).empty:
+            try:
+                if not self._Retrieve(date.today() - timedelta(days=7), date.today()).empty:
+                    return
+            except SourceError:
+                # We can't tell right now, so leave the symbol as it was.
+                self.symbol = original_symbol
                 return
         self.symbol = 'NO VALID LOOKUP FOR {}'.format(original_symbol)
 
-    @rate_limited(1, 15)
     def _Retrieve(self, start, end):
+        full = (date.today() - start).days >= 100
+        json = cached_response(self.provider, self.symbol, start, end, lambda: self._Query(full))
+        if json is None:
+            return pandas.Series()
+        return pandas.Series({parser.parse(day).date(): Decimal(vals['4. close']) for day, vals in
+                              json['Time Series (Daily)'].items() if str(start) <= day <= str(end)})
+
+    @guarded
+    @alphavantage_throttle
+    def _Query(self, full):
         params = {'function': 'TIME_SERIES_DAILY', 'apikey': self.api_key,
                   'symbol': self.symbol}
-        if (date.today() - start).days >= 100:
+        if full:
             params['outputsize'] = 'full'
 
-        r = requests.get('https://www.alphavantage.co/query', params=params)
-        if r.ok:
-            json = r.json()
-            try:
-                data = {parser.parse(day).date(): Decimal(vals['4. close']) for day, vals in
-                        json['Time Series (Daily)'].items() if str(start) <= day <= str(end)}
-                return pandas.Series(data)
-            except KeyError:
-                pass
+        r = requests.get('https://www.alphavantage.co/query', params=params, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+        json = r.json()
+        if 'Time Series (Daily)' in json:
+            return json
+        if 'Error Message' not in json:
+            # A rate limit note or some other problem on their end, not a bad symbol.
+            raise SourceError('Failed to get data, response: {}'.format(r.content))
 
         print('Failed to get data, response: {}'.format(r.content))
-        return pandas.Series()
+        return None
 
 
 class AlphaVantageCurrencySource(DataSourceMixin):
@@ -130,28 +196,38 @@ class AlphaVantageCurrencySource(DataSourceMixin):
     from_symbol = models.CharField(max_length=32)
     to_symbol = models.CharField(max_length=32, default='CAD')
 
+    provider = 'alphavantage'
+
     def __str__(self):
         return "AlphaVantageCurrency source for {} to {} ({})".format(self.from_symbol, self.to_symbol, self.priority)
 
     def __repr__(self):
         return "AlphaVantageCurrencySource<{},{},{}>".format(self.from_symbol, self.to_symbol, self.priority)
 
-    @rate_limited(1, 2)
     def _Retrieve(self, start, end):
+        symbol = '{}{}'.format(self.from_symbol, self.to_symbol)
+        json = cached_response(self.provider, symbol, date.today(), date.today(), self._Query)
+        if json is None:
+            return pandas.Series()
+        price = Decimal(json['Realtime Currency Exchange Rate']['5. Exchange Rate'])
+        return pandas.Series(data=[price], index=[date.today()])
+
+    @guarded
+    @alphavantage_throttle
+    def _Query(self):
         params = {'function': 'CURRENCY_EXCHANGE_RATE', 'apikey': self.api_key,
                   'from_currency': self.from_symbol, 'to_currency': self.to_symbol}
 
-        response = requests.get('https://www.alphavantage.co/query', params=params)
-        if response.ok:
-            json = response.json()
-            try:
-                price = Decimal(json['Realtime Currency Exchange Rate']['5. Exchange Rate'])
-                return pandas.Series(data=[price], index=[date.today()])
-            except KeyError:
-                pass
+        response = requests.get('https://www.alphavantage.co/query', params=params, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        json = response.json()
+        if '5. Exchange Rate' in json.get('Realtime Currency Exchange Rate', {}):
+            return json
+        if 'Error Message' not in json:
+            raise SourceError('Failed to get data, response: {}'.format(response.content))
 
         print('Failed to get data, response: {}'.format(response.content))
-        return pandas.Series()
+        return None
 
 
 class MorningstarDataSource(DataSourceMixin):
@@ -159,6 +235,8 @@ class MorningstarDataSource(DataSourceMixin):
                                default='https://api.morningstar.com/service/mf/Price/Mstarid/{}?format=json&username=morningstar&password=ForDebug&startdate={}&enddate={}')
     symbol = models.CharField(max_length=32, default=None)
 
+    provider = 'morningstar'
+
     def __str__(self):
         return "Morningstar {} ({})".format(self.symbol, self.priority)
 
@@ -166,13 +244,24 @@ class MorningstarDataSource(DataSourceMixin):
         return "MorningstarDataSource<{},{}>".format(self.symbol, self.priority)
 
     def _Retrieve(self, start, end):
+        json = cached_response(self.provider, self.symbol, start, end, lambda: self._Query(start, end))
+        if json is None:
+            return pandas.Series()
+        return pandas.Series({parser.parse(item['d']).date(): Decimal(item['v'])
+                              for item in json['data']['Prices']})
+
+    @guarded
+    def _Query(self, start, end):
         url = self.raw_url.format(self.symbol, str(start), str(end))
-        r = requests.get(url)
-        json = r.json()
+        r = requests.get(url, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+        try:
+            json = r.json()
+        except ValueError as e:
+            raise SourceError('Bad response from morningstar: {}'.format(r.content)) from e
         if 'data' in json and 'Prices' in json['data']:
-            return pandas.Series({parser.parse(item['d']).date(): Decimal(item['v'])
-                                  for item in json['data']['Prices']})
-        return pandas.Series()
+            return json
+        return None
 
 
 class InterpolatedDataSource(DataSourceMixin):
@@ -194,3 +283,101 @@ class InterpolatedDataSource(DataSourceMixin):
         series[self.start_day] = self.start_val
         series[self.end_day] = self.end_val
         return series.interpolate()[start:end]
+
+
+def missing_ranges(known, start, end):
+    """
+    :param known: The (start, end) ranges we already have, sorted by start. They may overlap.
+    :return: A list of the (start, end) ranges within start..end that aren't known.
+    """
+    missing = []
+    cursor = start
+    for known_start, known_end in known:
+        if cursor > end or known_start > end:
+            break
+        if known_end < cursor:
+            continue
+        if known_start > cursor:
+            missing.append((cursor, known_start - timedelta(days=1)))
+        cursor = known_end + timedelta(days=1)
+    if cursor <= end:
+        missing.append((cursor, end))
+    return missing
+
+
+class DataSourceCoverageQuerySet(models.QuerySet):
+    def known(self):
+        """ Ranges that returned data, or that came back empty too many times to bother asking again."""
+        return self.filter(Q(empty_attempts=0) | Q(empty_attempts__gte=self.model.MAX_EMPTY_ATTEMPTS))
+
+    def missing_ranges(self, start, end):
+        return missing_ranges(self.known().order_by('start').values_list('start', 'end'), start, end)
+
+    def record(self, datasource, security, start, end, empty):
+        """
+        Remembers that we asked datasource for security's prices from start to end.
+        Today is never recorded, since its price can still change.
+        """
+        end = min(end, date.today() - timedelta(days=1))
+        if end < start:
+            return
+
+        ranges = self.filter(datasource=datasource, security=security)
+        last_fetched = None
+        with transaction.atomic():
+            if empty:
+                # Fold in every empty range this one overlaps, and count one more attempt. An empty
+                # answer stays in the response cache for EMPTY_TTL, so within that it isn't a new attempt.
+                overlapping = ranges.filter(empty_attempts__gt=0, start__lte=end, end__gte=start)
+                bounds = overlapping.aggregate(Min('start'), Max('end'), Max('empty_attempts'), Max('last_fetched'))
+                attempts = bounds['empty_attempts__max'] or 0
+                last_fetched = bounds['last_fetched__max']
+                if last_fetched is None or timezone.now() - last_fetched >= timedelta(seconds=EMPTY_TTL):
+                    attempts += 1
+                    last_fetched = None
+            else:
+                # Fold in every range with data that this one overlaps or touches, and any empty ones inside it.
+                day = timedelta(days=1)
+                overlapping = ranges.filter(Q(empty_attempts=0, start__lte=end + day, end__gte=start - day) |
+                                            Q(empty_attempts__gt=0, start__gte=start, end__lte=end))
+                bounds = overlapping.aggregate(Min('start'), Max('end'))
+                attempts = 0
+            start = min(start, bounds['start__min'] or start)
+            end = max(end, bounds['end__max'] or end)
+            overlapping.delete()
+            coverage = self.create(datasource=datasource, security=security, start=start, end=end,
+                                   empty_attempts=attempts)
+            if last_fetched:
+                # Keep the time of the attempt we counted, which create() overwrote.
+                self.filter(pk=coverage.pk).update(last_fetched=last_fetched)
+
+    def record_all(self, security, fetched):
+        """
+        :param fetched: A list of (datasource, start, end, empty), as filled in by get_data_from_sources.
+        """
+        for datasource, start, end, empty in fetched:
+            self.record(datasource, security, start, end, empty)
+
+
+class DataSourceCoverage(models.Model):
+    """
+    A range of days we have already asked a network datasource for, for one security.
+    """
+    # An empty range is asked for again until it has come back empty this many times.
+    MAX_EMPTY_ATTEMPTS = 3
+
+    datasource = models.ForeignKey(DataSourceMixin, on_delete=models.CASCADE, related_name='coverage')
+    security = models.ForeignKey('securities.Security', on_delete=models.CASCADE, related_name='coverage')
+    start = models.DateField()
+    end = models.DateField()
+    empty_attempts = models.IntegerField(default=0)
+    last_fetched = models.DateTimeField(auto_now=True)
+
+    objects = DataSourceCoverageQuerySet.as_manager()
+
+    class Meta:
+        index_together = ['datasource', 'security']
+
+    def __str__(self):
+        return "{} {} {} - {} ({})".format(self.datasource, self.security_id, self.start, self.end,
+                                          'empty x{}'.format(self.empty_attempts) if self.empty_attempts else 'data')
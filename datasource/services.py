@@ -1,28 +1,151 @@
 import json
 from datetime import timedelta
+from decimal import Decimal
 
+import numpy
 import pandas
 import requests
 
+from .breaker import SourceError
 
-def get_data_from_sources(sources, start, end):
+
+def get_data_from_sources(sources, start, end, security=None, fetched=None, prefetched=None):
     """
     Gets data from all sources for the specified range and merges them by priority.
+    If security is given, network sources are only asked for the days their coverage doesn't know yet,
+    and only days its exchange is open (or that a source had a price for) are returned.
+    :param fetched: If a list is given, the (source, start, end, empty) of each of those requests is
+                    appended to it, for the caller to record once the data is saved.
+    :param prefetched: A dict of source pk -> pandas.Series already retrieved for the whole range,
+                       which is used instead of asking those sources again.
     Returns a pandas DataFrame
     """
     start = start - timedelta(days=7)
 
-    index = pandas.DatetimeIndex(start=start, end=end, freq='D').date
-    merged_frame = pandas.DataFrame(index=index, columns=['price', 'priority'], dtype='float64')
-
+    calendar = security.trading_calendar if security is not None else None
+    retrieved = []
     for source in sources.order_by('priority'):
-        print("Getting data from {} for {} to {}".format(source, start, end))
-        data = source._Retrieve(start, end)
+        use_coverage = security is not None and source.provider
+        if use_coverage:
+            ranges = source.coverage.filter(security=security).missing_ranges(start, end)
+            if calendar is not None:
+                ranges = [(s, e) for s, e in ranges if calendar.open_days(s, e)]
+        else:
+            ranges = [(start, end)]
+        if not ranges:
+            continue
+
+        # One request spanning every gap, since some providers send their whole history whatever is asked for.
+        hull_start, hull_end = ranges[0][0], ranges[-1][1]
+        print("Getting data from {} for {} to {}".format(source, hull_start, hull_end))
+        try:
+            if prefetched and source.pk in prefetched:
+                data = prefetched[source.pk]
+            else:
+                data = source._Retrieve(hull_start, hull_end)
+        except SourceError as e:
+            # Fall back on the other sources, and try this one again next sync.
+            print("Skipping {}: {}".format(source, e))
+            continue
         if not isinstance(data, pandas.Series):
             data = pandas.Series(dict(data))
-        data.name = 'price'
+
+        for range_start, range_end in ranges:
+            part = between(data, range_start, range_end)
+            retrieved.append((source.priority, part))
+            if use_coverage and fetched is not None:
+                fetched.extend(coverage_of(source, range_start, range_end, part))
+
+    return merge_by_priority(retrieved, start, end, calendar)
+
+
+def between(data, start, end):
+    """
+    :return: The part of a pandas.Series indexed by day from start to end inclusive.
+    """
+    days = pandas.to_datetime(data.index)
+    return data[(days >= pandas.Timestamp(start)) & (days <= pandas.Timestamp(end))]
+
+
+def coverage_of(source, start, end, data):
+    """
+    :return: The (source, start, end, empty) ranges that asking source for start to end covered.
+             Only the days from its first value to its last count as having data. The days around
+             them count as empty: the provider may not have published them yet, or may only give
+             recent prices, so they are asked for again until they have come back empty enough times.
+    """
+    data = between(data, start, end)
+    if data.empty:
+        return [(source, start, end, True)]
+    first = pandas.Timestamp(data.index.min()).date()
+    last = pandas.Timestamp(data.index.max()).date()
+    ranges = [(source, first, last, False)]
+    if first > start:
+        ranges.insert(0, (source, start, first - timedelta(days=1), True))
+    if last < end:
+        ranges.append((source, last + timedelta(days=1), end, True))
+    return ranges
+
+
+def to_decimal(value):
+    if isinstance(value, Decimal):
+        return value
+    # str() gives the shortest repr of a float, so 12.34 stays 12.34 instead of 12.339999...
+    return Decimal(str(value))
+
+
+def merge_by_priority(retrieved, start, end, calendar=None):
+    """
+    Merges the price series of several sources onto one daily index from start to end.
+    :param retrieved: A list of (priority, pandas.Series) in ascending priority order.
+    :param calendar: A TradingCalendar. If given, days it is closed on are only kept if a source had a price.
+    On each day the last source with a value wins. Days with no value are filled forward
+    from the day before with priority 0, and days before the first value are dropped.
+    :return: A DataFrame of Decimal 'price' and int 'priority', indexed by datetime.date.
+    """
+    days = numpy.arange(numpy.datetime64(start, 'D'), numpy.datetime64(end, 'D') + 1)
+    if not retrieved or not len(days):
+        return pandas.DataFrame(columns=['price', 'priority'])
+
+    values = numpy.empty((len(retrieved), len(days)), dtype=object)
+    has_value = numpy.zeros((len(retrieved), len(days)), dtype=bool)
+    priorities = numpy.array([priority for priority, _ in retrieved], dtype=int)
+    for row, (_, series) in enumerate(retrieved):
+        series = series[series.notnull()]
+        if series.empty:
+            continue
+        positions = (pandas.to_datetime(series.index).values.astype('datetime64[D]') - days[0]).astype(int)
+        in_range = (positions >= 0) & (positions < len(days))
+        values[row, positions[in_range]] = numpy.array(
+            [to_decimal(v) for v in series.values[in_range]], dtype=object)
+        has_value[row, positions[in_range]] = True
+
+    # The winning source on each day is the last row with a value.
+    found = has_value.any(axis=0)
+    winner = len(retrieved) - 1 - has_value[::-1].argmax(axis=0)
+    prices = values[winner, numpy.arange(len(days))]
+
+    # Every day takes its price from the last day that had one.
+    filled_from = numpy.maximum.accumulate(numpy.where(found, numpy.arange(len(days)), -1))
+    keep = filled_from >= 0
+    if calendar is not None:
+        keep &= found | calendar.open_mask(days)
+    return pandas.DataFrame({'price': prices[filled_from[keep]],
+                             'priority': numpy.where(found, priorities[winner], 0)[keep]},
+                            index=days[keep].astype(object), columns=['price', 'priority'])
+
+
+def merge_by_update(retrieved, start, end):
+    """
+    The DataFrame.update equivalent of merge_by_priority, in float64. Kept around for benchmarking.
+    """
+    index = pandas.date_range(start=start, end=end, freq='D').date
+    merged_frame = pandas.DataFrame(index=index, columns=['price', 'priority'], dtype='float64')
+
+    for priority, data in retrieved:
+        data = data.rename('price')
         frame = pandas.DataFrame(data)
-        frame['priority'] = source.priority
+        frame['priority'] = priority
         merged_frame.update(frame)
 
     merged_frame.update(merged_frame.price.fillna(method='ffill'))
@@ -1,9 +1,19 @@
 # Create your tests here.
-from datetime import date
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
 
-from django.test import TestCase
+import pandas
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
 
+from datasource.cache import EMPTY_TTL, cached_response, response_ttl
 from datasource.models import *
+from datasource.breaker import CircuitBreaker, SourceError, guarded
+from datasource.throttle import TokenBucket, throttled
+from datasource.services import coverage_of, get_data_from_sources, merge_by_priority
+from securities.models import Security
 
 
 class DataSourceMixinTestCase(TestCase):
@@ -83,4 +93,205 @@ class AlphavantageDataSourceTestCase(TestCase):
         self.assertEqual(self.tsladata[-1][0], date(2018, 1, 6))
 
 
+class AlphavantageThrottleTestCase(SimpleTestCase):
+    def test_sources_share_quota(self):
+        self.assertIs(AlphaVantageStockSource._Query.bucket, AlphaVantageCurrencySource._Query.bucket)
 
+
+class MergeByPriorityTestCase(SimpleTestCase):
+    def series(self, pairs):
+        return pandas.Series(dict(pairs))
+
+    def test_higher_priority_wins(self):
+        low = self.series([(date(2018, 1, 1), Decimal('1.5')), (date(2018, 1, 2), Decimal('2.5'))])
+        high = self.series([(date(2018, 1, 2), Decimal('20.25'))])
+        merged = merge_by_priority([(10, low), (20, high)], date(2018, 1, 1), date(2018, 1, 2))
+        self.assertEqual(list(merged.price), [Decimal('1.5'), Decimal('20.25')])
+        self.assertEqual(list(merged.priority), [10, 20])
+
+    def test_fills_forward_with_priority_zero(self):
+        data = self.series([(date(2018, 1, 2), Decimal('3.123456'))])
+        merged = merge_by_priority([(20, data)], date(2018, 1, 1), date(2018, 1, 4))
+        self.assertEqual(list(merged.index), [date(2018, 1, 2), date(2018, 1, 3), date(2018, 1, 4)])
+        self.assertEqual(list(merged.price), [Decimal('3.123456')] * 3)
+        self.assertEqual(list(merged.priority), [20, 0, 0])
+
+    def test_floats_become_exact_decimals(self):
+        data = pandas.Series([12.34], index=pandas.date_range(date(2018, 1, 1), date(2018, 1, 1)))
+        merged = merge_by_priority([(20, data)], date(2018, 1, 1), date(2018, 1, 1))
+        self.assertEqual(merged.price[date(2018, 1, 1)], Decimal('12.34'))
+
+    def test_ignores_missing_values_and_days_out_of_range(self):
+        low = self.series([(date(2018, 1, 1), Decimal(1))])
+        high = self.series([(date(2018, 1, 1), None), (date(2018, 2, 1), Decimal(5))])
+        merged = merge_by_priority([(10, low), (20, high)], date(2018, 1, 1), date(2018, 1, 1))
+        self.assertEqual(list(merged.price), [Decimal(1)])
+
+    def test_no_data(self):
+        self.assertTrue(merge_by_priority([(20, pandas.Series())], date(2018, 1, 1), date(2018, 1, 2)).empty)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'datasource': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedResponseTestCase(SimpleTestCase):
+    def setUp(self):
+        self.calls = 0
+
+    def fetch(self, response):
+        def fn():
+            self.calls += 1
+            return response
+        return fn
+
+    def test_second_request_is_cached(self):
+        for _ in range(2):
+            response = cached_response('test', 'CACHED', date(2017, 1, 1), date(2017, 2, 1), self.fetch({'a': 1}))
+        self.assertEqual(response, {'a': 1})
+        self.assertEqual(self.calls, 1)
+
+    def test_different_ranges_are_separate(self):
+        cached_response('test', 'RANGES', date(2017, 1, 1), date(2017, 2, 1), self.fetch({'a': 1}))
+        cached_response('test', 'RANGES', date(2017, 1, 1), date(2017, 3, 1), self.fetch({'a': 2}))
+        self.assertEqual(self.calls, 2)
+
+    def test_empty_is_cached_briefly(self):
+        for _ in range(2):
+            self.assertIsNone(cached_response('test', 'EMPTY', date(2017, 1, 1), date(2017, 2, 1), self.fetch(None)))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(response_ttl(None, date(2017, 2, 1)), EMPTY_TTL)
+
+    def test_failures_are_not_cached(self):
+        def fail():
+            self.calls += 1
+            raise SourceError('down')
+        for _ in range(2):
+            with self.assertRaises(SourceError):
+                cached_response('test', 'FAILED', date(2017, 1, 1), date(2017, 2, 1), fail)
+        self.assertEqual(self.calls, 2)
+
+
+class MissingRangesTestCase(SimpleTestCase):
+    def test_nothing_known(self):
+        self.assertEqual(missing_ranges([], date(2018, 1, 1), date(2018, 1, 31)),
+                         [(date(2018, 1, 1), date(2018, 1, 31))])
+
+    def test_gaps_between_known_ranges(self):
+        known = [(date(2017, 12, 1), date(2018, 1, 5)), (date(2018, 1, 10), date(2018, 1, 20))]
+        self.assertEqual(missing_ranges(known, date(2018, 1, 1), date(2018, 1, 31)),
+                         [(date(2018, 1, 6), date(2018, 1, 9)), (date(2018, 1, 21), date(2018, 1, 31))])
+
+    def test_fully_known(self):
+        known = [(date(2018, 1, 1), date(2018, 1, 20)), (date(2018, 1, 15), date(2018, 2, 1))]
+        self.assertEqual(missing_ranges(known, date(2018, 1, 1), date(2018, 1, 31)), [])
+
+
+class DataSourceCoverageTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.security = Security.objects.create(symbol='COVERED', currency='CAD')
+        cls.datasource = ConstantDataSource.objects.create(value=1)
+
+    def coverage(self):
+        return DataSourceCoverage.objects.filter(datasource=self.datasource, security=self.security)
+
+    def test_touching_ranges_merge(self):
+        DataSourceCoverage.objects.record(self.datasource, self.security, date(2018, 1, 1), date(2018, 1, 10), False)
+        DataSourceCoverage.objects.record(self.datasource, self.security, date(2018, 1, 11), date(2018, 1, 20), False)
+        self.assertEqual(list(self.coverage().values_list('start', 'end')), [(date(2018, 1, 1), date(2018, 1, 20))])
+        self.assertEqual(self.coverage().missing_ranges(date(2018, 1, 1), date(2018, 1, 25)),
+                         [(date(2018, 1, 21), date(2018, 1, 25))])
+
+    def record_empty_at(self, hours):
+        with mock.patch('django.utils.timezone.now', return_value=self.now + timedelta(hours=hours)):
+            DataSourceCoverage.objects.record(self.datasource, self.security, date(2018, 1, 1), date(2018, 1, 10), True)
+
+    def test_empty_range_known_after_repeated_attempts(self):
+        self.now = timezone.now()
+        for attempt in range(DataSourceCoverage.MAX_EMPTY_ATTEMPTS - 1):
+            self.record_empty_at(hours=2 * attempt)
+            self.assertEqual(len(self.coverage().missing_ranges(date(2018, 1, 1), date(2018, 1, 10))), 1)
+        self.record_empty_at(hours=2 * DataSourceCoverage.MAX_EMPTY_ATTEMPTS)
+        self.assertEqual(self.coverage().missing_ranges(date(2018, 1, 1), date(2018, 1, 10)), [])
+
+    def test_cached_empty_answer_not_counted_again(self):
+        self.now = timezone.now()
+        for minutes in range(0, 60 * DataSourceCoverage.MAX_EMPTY_ATTEMPTS, 15):
+            self.record_empty_at(hours=minutes / 60)
+        self.assertEqual(self.coverage().get().empty_attempts, DataSourceCoverage.MAX_EMPTY_ATTEMPTS)
+        self.assertEqual(len(self.coverage().missing_ranges(date(2018, 1, 1), date(2018, 1, 10))), 0)
+
+    def test_tail_after_last_price_is_empty(self):
+        data = pandas.Series([1, 2], index=[date(2018, 1, 1), date(2018, 1, 2)])
+        self.assertEqual(coverage_of(self.datasource, date(2018, 1, 1), date(2018, 1, 3), data),
+                         [(self.datasource, date(2018, 1, 1), date(2018, 1, 2), False),
+                          (self.datasource, date(2018, 1, 3), date(2018, 1, 3), True)])
+
+    def test_head_before_first_price_is_empty(self):
+        # Realtime sources only have today's price, which says nothing about the days before it.
+        data = pandas.Series([1], index=[date(2018, 1, 5)])
+        self.assertEqual(coverage_of(self.datasource, date(2018, 1, 1), date(2018, 1, 10), data),
+                         [(self.datasource, date(2018, 1, 1), date(2018, 1, 4), True),
+                          (self.datasource, date(2018, 1, 5), date(2018, 1, 5), False),
+                          (self.datasource, date(2018, 1, 6), date(2018, 1, 10), True)])
+
+    def test_one_request_for_every_gap(self):
+        DataSourceCoverage.objects.record(self.datasource, self.security, date(2018, 1, 8), date(2018, 1, 12), False)
+        retrieve = mock.Mock(side_effect=lambda start, end: pandas.Series(1, index=pandas.date_range(start, end)))
+        fetched = []
+        with mock.patch.object(ConstantDataSource, 'provider', 'constant'), \
+                mock.patch.object(ConstantDataSource, '_Retrieve', retrieve):
+            get_data_from_sources(ConstantDataSource.objects.filter(pk=self.datasource.pk),
+                                  date(2018, 1, 8), date(2018, 1, 19), self.security, fetched)
+        retrieve.assert_called_once_with(date(2018, 1, 1), date(2018, 1, 19))
+        self.assertEqual([(start, end, empty) for _, start, end, empty in fetched],
+                         [(date(2018, 1, 1), date(2018, 1, 7), False), (date(2018, 1, 13), date(2018, 1, 19), False)])
+
+    def test_today_is_never_known(self):
+        DataSourceCoverage.objects.record(self.datasource, self.security, date(2018, 1, 1), date.today(), False)
+        self.assertEqual(self.coverage().missing_ranges(date(2018, 1, 1), date.today()),
+                         [(date.today(), date.today())])
+
+
+class GuardedLatencyTestCase(SimpleTestCase):
+    class Source:
+        provider = 'latency'
+
+        @guarded
+        @throttled('latency', calls=1, period=1)
+        def _Query(self):
+            return 'ok'
+
+    def test_throttle_wait_not_counted(self):
+        with mock.patch.object(TokenBucket, 'acquire', lambda bucket: time.sleep(0.2)), \
+                mock.patch.object(CircuitBreaker, 'allow', return_value=True), \
+                mock.patch.object(CircuitBreaker, 'record') as record:
+            self.assertEqual(self.Source()._Query(), 'ok')
+        ok, seconds = record.call_args[0]
+        self.assertTrue(ok)
+        self.assertLess(seconds, 0.1)
+
+
+class SourceFallbackTestCase(TestCase):
+    def test_failing_source_falls_back_to_lower_priority(self):
+        low = ConstantDataSource.objects.create(value=1, priority=DataSourceMixin.PRIORITY_LOW)
+        high = ConstantDataSource.objects.create(value=2, priority=DataSourceMixin.PRIORITY_DAILY)
+        retrieve = ConstantDataSource._Retrieve
+
+        def failing_retrieve(source, start, end):
+            if source.pk == high.pk:
+                raise SourceError('down')
+            return retrieve(source, start, end)
+
+        with mock.patch.object(ConstantDataSource, '_Retrieve', failing_retrieve):
+            data = get_data_from_sources(ConstantDataSource.objects.filter(pk__in=[low.pk, high.pk]),
+                                         date(2018, 1, 1), date(2018, 1, 3))
+        self.assertEqual(set(data.price), {Decimal(1)})
+        self.assertEqual(set(data.priority), {DataSourceMixin.PRIORITY_LOW})
+
+    def test_prefetched_series_are_used(self):
+        source = ConstantDataSource.objects.create(value=1)
+        prefetched = {source.pk: pandas.Series([Decimal(3)], index=pandas.date_range(date(2018, 1, 2), date(2018, 1, 2)))}
+        data = get_data_from_sources(ConstantDataSource.objects.filter(pk=source.pk),
+                                     date(2018, 1, 1), date(2018, 1, 3), prefetched=prefetched)
+        self.assertEqual(set(data.price), {Decimal(3)})
@@ -0,0 +1,119 @@
+"""
+A token bucket rate limiter shared by every process, stored in the default Redis cache.
+
+Usage:
+    @throttled('alphavantage', calls=1, period=15)
+    def _Query(self, start, end):
+        ...
+
+By default a call waits for a token. Inside a `with nonblocking():` block it raises
+Throttled instead, so a scheduler can go work on something else and retry later.
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from django_redis import get_redis_connection
+
+# Refill the bucket for the time elapsed since the last call, then try to take one token.
+# Returns the number of seconds until a token is available, 0 if we got one.
+TAKE_TOKEN_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or capacity)
+local last = tonumber(redis.call('HGET', KEYS[1], 'last') or now)
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+_local = threading.local()
+
+
+class Throttled(Exception):
+    def __init__(self, provider, retry_after):
+        self.provider = provider
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return 'Rate limit for {} reached, retry in {:.1f}s'.format(self.provider, self.retry_after)
+
+
+class TokenBucket:
+    def __init__(self, provider, calls, period):
+        """
+        Allows `calls` calls every `period` seconds to `provider`, across all workers.
+        """
+        self.provider = provider
+        self.capacity = calls
+        self.rate = calls / period
+        self.key = 'throttle:{}'.format(provider)
+
+    def __repr__(self):
+        return 'TokenBucket<{},{}/s>'.format(self.provider, self.rate)
+
+    def _take(self):
+        redis = get_redis_connection('default')
+        wait = redis.eval(TAKE_TOKEN_SCRIPT, 1, self.key, self.capacity, self.rate, time.time())
+        return float(wait)
+
+    def try_acquire(self):
+        """
+        :return: 0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        return self._take()
+
+    def acquire(self):
+        """ Blocks until a token is taken."""
+        wait = self._take()
+        while wait:
+            time.sleep(wait)
+            wait = self._take()
+
+
+def time_waiting():
+    """
+    :return: The total seconds this thread has spent waiting for tokens. Callers timing a
+             throttled call subtract the difference, so a busy bucket doesn't look like a slow provider.
+    """
+    return getattr(_local, 'waited', 0)
+
+
+@contextmanager
+def nonblocking():
+    """ Within this block, throttled calls on this thread raise Throttled instead of waiting."""
+    previous = getattr(_local, 'nonblocking', False)
+    _local.nonblocking = True
+    try:
+        yield
+    finally:
+        _local.nonblocking = previous
+
+
+def throttled(provider, calls, period):
+    bucket = TokenBucket(provider, calls, period)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'nonblocking', False):
+                wait = bucket.try_acquire()
+                if wait:
+                    raise Throttled(provider, wait)
+            else:
+                start = time.perf_counter()
+                bucket.acquire()
+                _local.waited = time_waiting() + time.perf_counter() - start
+            return fn(*args, **kwargs)
+        wrapper.bucket = bucket
+        return wrapper
+    return decorator
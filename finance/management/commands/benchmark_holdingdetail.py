@@ -0,0 +1,58 @@
+"""
+Times scoped HoldingDetail.Refresh calls against a full refresh as the table grows.
+
+Usage: manage.py benchmark_holdingdetail [--copies 0 1 3 7]
+
+The table is grown by cloning every account's holdings into new accounts. Everything runs
+inside a transaction that is rolled back, so no data is left behind.
+"""
+import datetime
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from finance.models import BaseAccount, Holding, HoldingDetail
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark scoped HoldingDetail refreshes against table size.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--copies', type=int, nargs='+', default=[0, 1, 3, 7])
+
+    def clone_accounts(self, copies):
+        holdings = list(Holding.objects.all())
+        accounts = list(BaseAccount.objects.non_polymorphic())
+        for i in range(copies):
+            for account in accounts:
+                clone = BaseAccount.objects.create(type='Benchmark', account_id='{}-{}'.format(account.pk, i))
+                Holding.objects.bulk_create(
+                    Holding(account=clone, security_id=h.security_id, qty=h.qty,
+                            startdate=h.startdate, enddate=h.enddate)
+                    for h in holdings if h.account_id == account.pk)
+
+    def timed(self, **scope):
+        start = time.perf_counter()
+        HoldingDetail.Refresh(**scope)
+        return time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        account = BaseAccount.objects.non_polymorphic().first()
+        today = datetime.date.today()
+        self.stdout.write('{:>10} {:>10} {:>10} {:>10}'.format('rows', 'full', 'account', 'today'))
+        for copies in options['copies']:
+            try:
+                with transaction.atomic():
+                    self.clone_accounts(copies)
+                    HoldingDetail.Refresh()
+                    rows = HoldingDetail.objects.count()
+                    self.stdout.write('{:>10} {:>9.3f}s {:>9.3f}s {:>9.3f}s'.format(
+                        rows, self.timed(), self.timed(accounts=[account.pk]), self.timed(start=today)))
+                    raise Rollback
+            except Rollback:
+                pass
@@ -0,0 +1,71 @@
+"""
+Compares BaseAccount.BuildHoldings against the old effect-at-a-time BuildHoldingsIterative.
+
+Usage: manage.py benchmark_regenerate_holdings [--activities 10000] [--securities 20]
+
+A synthetic account is created inside a transaction that is rolled back, so no data is left behind.
+"""
+import datetime
+import random
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from finance.models import Activity, BaseAccount, BaseRawActivity, Holding
+from securities.models import Security
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark holding regeneration on a synthetic account.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--activities', type=int, default=10000)
+        parser.add_argument('--securities', type=int, default=20)
+
+    def create_account(self, num_activities, num_securities):
+        cad = Security(symbol='BENCHCAD', type=Security.Type.Cash, currency='CAD')
+        cad.save()
+        symbols = []
+        for i in range(num_securities):
+            security = Security(symbol='BENCH{}'.format(i), currency='CAD')
+            security.save()
+            symbols.append(security.symbol)
+
+        account = BaseAccount.objects.create(type='Benchmark', account_id='benchmark')
+        raws = BaseRawActivity.objects.bulk_create(BaseRawActivity(account=account) for _ in range(num_activities))
+        day = datetime.date.today() - datetime.timedelta(days=num_activities // 3)
+        activities = []
+        for raw in raws:
+            day += datetime.timedelta(days=random.randint(0, 1))
+            qty = Decimal(random.randint(1, 100))
+            activities.append(Activity(account=account, trade_date=day, security_id=random.choice(symbols),
+                                       cash_id=cad.symbol, description='', qty=qty, price=10,
+                                       net_amount=-qty * 10, type=Activity.Type.Buy, raw=raw))
+        Activity.objects.bulk_create(activities)
+        return account
+
+    def timed(self, fn):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+        return elapsed, len(queries)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                account = self.create_account(options['activities'], options['securities'])
+                for name, fn in [('iterative', account.BuildHoldingsIterative), ('bulk', account.BuildHoldings)]:
+                    elapsed, queries = self.timed(fn)
+                    self.stdout.write('{:>10}: {:8.3f}s {:7} queries {:6} holdings'.format(
+                        name, elapsed, queries, Holding.objects.filter(account=account).count()))
+                raise Rollback
+        except Rollback:
+            pass
@@ -0,0 +1,70 @@
+"""
+Times the vectorized xirr_batch solver against solving each set of cashflows with the old secant xirr.
+
+Usage: manage.py benchmark_xirr [--sets 10 100 1000] [--months 120]
+
+The cashflows are random monthly deposits followed by one withdrawal, from a fixed seed so runs
+are comparable. A secant result counts as bad if it raised, is complex, or isn't actually a root:
+the secant method can stop on a rate where the NPV is nowhere near zero.
+"""
+import datetime
+import random
+import time
+
+import numpy
+from django.core.management.base import BaseCommand
+
+from utils.misc import xirr_batch, xirr_secant, xnpv
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the batch XIRR solver against the scalar secant solver.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sets', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--months', type=int, default=120, help='The longest set of monthly cashflows')
+
+    def make_sets(self, count, months):
+        rng = random.Random(count)
+        start = datetime.date(2010, 1, 1)
+        sets = []
+        for _ in range(count):
+            cashflows = [(start + datetime.timedelta(days=30 * m), -rng.uniform(0, 1000))
+                         for m in range(rng.randint(2, months))]
+            invested = -sum(amount for _, amount in cashflows)
+            cashflows.append((start + datetime.timedelta(days=30 * len(cashflows)), invested * rng.uniform(0.7, 2)))
+            sets.append(cashflows)
+        return sets
+
+    def solve_secant(self, sets):
+        rates = []
+        for cashflows in sets:
+            try:
+                rate = xirr_secant(cashflows)
+            except (OverflowError, ZeroDivisionError):
+                rate = numpy.nan
+            scale = sum(abs(amount) for _, amount in cashflows)
+            if not isinstance(rate, float) or abs(xnpv(rate, cashflows)) > 1e-6 * scale:
+                rate = numpy.nan
+            rates.append(rate)
+        return numpy.array(rates)
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:>8} {:>10} {:>10} {:>8} {:>10} {:>10} {:>12}'.format(
+            'sets', 'secant', 'batch', 'speedup', 'secant bad', 'batch bad', 'max diff'))
+        for count in options['sets']:
+            sets = self.make_sets(count, options['months'])
+
+            start = time.perf_counter()
+            old = self.solve_secant(sets)
+            old_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            new, converged = xirr_batch(sets)
+            new_time = time.perf_counter() - start
+
+            both = ~numpy.isnan(old) & converged
+            max_diff = numpy.abs(old[both] - new[both]).max() if both.any() else 0
+            self.stdout.write('{:>8} {:>9.3f}s {:>9.3f}s {:>7.1f}x {:>10} {:>10} {:>12.2e}'.format(
+                count, old_time, new_time, old_time / new_time, numpy.isnan(old).sum(),
+                (~converged).sum(), max_diff))
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+def forward(apps, schema_editor):
+    # Raw SQL outside the historical models: replaces the financeview_holdingdetail materialized view
+    # with the table HoldingDetail.Refresh now upserts into.
+    from finance.models import HoldingDetail
+    HoldingDetail.CreateView()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('finance', '0032_auto_20201121_1544'),
+        ('securities', '0012_cadview_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, migrations.RunPython.noop)
+    ]
@@ -1,8 +1,11 @@
 import datetime
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import Max
+from django.db import connection, models, transaction
+from django.db.models import Max, Min
 from django.utils.functional import cached_property
 from polymorphic.managers import PolymorphicManager
 from polymorphic.models import PolymorphicModel
@@ -43,6 +46,8 @@ class BaseAccount(ShowFieldTypeAndContent, PolymorphicModel):
     objects = PolymorphicManager.from_queryset(BaseAccountQuerySet)()
 
     activitySyncDateRange = 30
+    # How many activitySyncDateRange windows may be fetched from the broker at once.
+    activitySyncConcurrency = 1
 
     class Meta:
         ordering = ['account_id']
@@ -79,14 +84,26 @@ class BaseAccount(ShowFieldTypeAndContent, PolymorphicModel):
             return last_activity + datetime.timedelta(days=1)
         return self.creation_date
 
+    @property
+    def last_activity_id(self):
+        return self.activities.aggregate(Max('pk'))['pk__max'] or 0
+
+    def earliest_activity_since(self, activity_id):
+        """
+        :return: The earliest trade_date of activities created after activity_id, or None if there are none.
+        """
+        return self.activities.filter(pk__gt=activity_id).aggregate(Min('trade_date'))['trade_date__min']
+
     def import_activities(self, csv_file):
-        activity_count = self.activities.all().count()
+        last_id = self.last_activity_id
 
         self.import_from_csv(csv_file)
-        if self.activities.all().count() > activity_count:
-            self.RegenerateHoldings()
+        earliest_new = self.earliest_activity_since(last_id)
+        if earliest_new:
+            self.RegenerateHoldings(earliest_new)
 
-        Security.objects.Sync(False)
+        from .holding import HoldingDetail
+        HoldingDetail.RefreshSyncedPrices(Security.objects.Sync(False))
 
     def import_from_csv(self, csv_file):
         """
@@ -96,17 +113,19 @@ class BaseAccount(ShowFieldTypeAndContent, PolymorphicModel):
         pass
 
     def SyncAndRegenerate(self):
-        activity_count = self.activities.all().count()
+        last_id = self.last_activity_id
 
         if self.activitySyncDateRange:
             date_range = utils.dates.day_intervals(self.activitySyncDateRange, self.sync_from_date)
             print('Syncing all activities for {} in {} chunks.'.format(self, len(date_range)))
 
-            for period in date_range:
-                self.CreateActivities(period.start, period.end)
+            # Windows are fetched concurrently, but written one at a time in order.
+            for fetched in self.FetchActivityWindows(date_range):
+                self.SaveActivities(fetched)
 
-        if self.activities.all().count() > activity_count:
-            self.RegenerateHoldings()
+        earliest_new = self.earliest_activity_since(last_id)
+        if earliest_new:
+            self.RegenerateHoldings(earliest_new)
 
     def RegenerateActivities(self):
         self.activities.all().delete()
@@ -115,7 +134,47 @@ class BaseAccount(ShowFieldTypeAndContent, PolymorphicModel):
                 raw.CreateActivity()
         self.RegenerateHoldings()
 
-    def RegenerateHoldings(self):
+    def RegenerateHoldings(self, start=None):
+        """
+        :param start: Only regenerate holdings from this datetime.date onward. None for all of them.
+        """
+        self.BuildHoldings(start)
+
+        from .holding import HoldingDetail
+        HoldingDetail.QueueRefresh(accounts=[self.pk], start=start)
+
+    def BuildHoldings(self, start=None):
+        """
+        Rebuilds our holdings from our activities, in one scan of the activities and one insert.
+        If start is given, holdings that ended before the day before start are kept. The ones
+        held the day before start are reopened and carried forward, and only the activities
+        from start onward are replayed. That includes a holding an earlier build closed because
+        of a trade on start, since replaying that trade needs the qty held before it.
+        """
+        from .holding import Holding
+        activities = self.activities.order_by('trade_date', 'pk').only(
+            'trade_date', 'type', 'security_id', 'cash_id', 'qty', 'net_amount')
+        with transaction.atomic():
+            if start:
+                activities = activities.filter(trade_date__gte=start)
+                day_before = start - datetime.timedelta(days=1)
+                held = list(self.holding_set.filter(startdate__lte=day_before).exclude(enddate__lt=day_before))
+                self.holding_set.filter(startdate__gte=start).delete()
+            else:
+                held = []
+                self.holding_set.all().delete()
+
+            for holding in held:
+                holding.enddate = None
+            new_holdings = Holding.objects.build_from_activities(self, activities, held)
+            for holding in held:
+                self.holding_set.filter(pk=holding.pk).update(enddate=holding.enddate)
+            Holding.objects.bulk_create(new_holdings)
+
+    def BuildHoldingsIterative(self):
+        """
+        The effect-at-a-time equivalent of BuildHoldings. Kept around for benchmarking.
+        """
         self.holding_set.all().delete()
         for activity in self.activities.all():
             for security, qty_delta in activity.GetHoldingEffects().items():
@@ -126,15 +185,60 @@ class BaseAccount(ShowFieldTypeAndContent, PolymorphicModel):
         """
         Retrieve raw activity data for the specified account and start/end period.
         Store it in the DB as a subclass of BaseRawActivity.
-        Return the newly created raw instances.
+        """
+        self.SaveActivities(self.FetchActivities(start, end))
+
+    def FetchActivities(self, start, end):
+        """
+        Override this to retrieve raw activity data for the specified start/end period from the broker.
+        It may run on a worker thread alongside other periods, so it shouldn't write to the DB.
+        Return whatever SaveActivities expects.
         """
         return []
 
+    def SaveActivities(self, fetched):
+        """
+        Override this to store what FetchActivities returned in the DB as subclasses of BaseRawActivity.
+        """
+        pass
+
+    def FetchActivityWindows(self, periods):
+        """
+        Fetches the activities of each period, up to activitySyncConcurrency periods at a time.
+        FetchActivities is then called from several threads at once, so it shouldn't share a client between them.
+        :return: A generator of what FetchActivities returned for each period, in the order of periods.
+        """
+        if self.activitySyncConcurrency <= 1:
+            for period in periods:
+                yield self.FetchActivities(period.start, period.end)
+            return
+
+        def fetch(period):
+            try:
+                return self.FetchActivities(period.start, period.end)
+            finally:
+                # Each worker thread has its own DB connection, don't leak it.
+                connection.close()
+
+        # Only a few windows are queued ahead of the workers. If one fails, or the caller stops early,
+        # the queued ones are cancelled and we don't wait for the ones still running.
+        pool = ThreadPoolExecutor(max_workers=self.activitySyncConcurrency)
+        periods = iter(periods)
+        pending = deque(pool.submit(fetch, period)
+                        for period in itertools.islice(periods, 2 * self.activitySyncConcurrency))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for period in itertools.islice(periods, 1):
+                    pending.append(pool.submit(fetch, period))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
     def GetValueAtDate(self, date):
-        result = self.holdingdetail_set.at_date(date).total_values().first()
-        if result:
-            return result[1]
-        return 0
+        return self.holdingdetail_set.value_at_date(date)
 
     def GetValueToday(self):
         return self.GetValueAtDate(datetime.date.today())
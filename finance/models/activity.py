@@ -200,6 +200,12 @@ class ActivityQuerySet(models.query.QuerySet, SecurityMixinQuerySet, DayMixinQue
         else:
             return self.deposits().values_list('trade_date', F('net_amount') * F('account__joint_share'))
 
+    def get_account_deposits(self):
+        """
+        :return: a list of (account_id, date, amt) tuples
+        """
+        return self.deposits().values_list('account_id', 'trade_date', F('net_amount') * F('account__joint_share'))
+
     def newest_date(self):
         """
         :return: The date of the most recent activity.
@@ -212,15 +218,17 @@ class ActivityQuerySet(models.query.QuerySet, SecurityMixinQuerySet, DayMixinQue
     def with_exchange_rates(self):
         """
         Annotates each activity of the QuerySet with a "exch" field.
+        Rates come from the CAD price details, which have every calendar day, so activities on
+        days the TSX is closed get the rate from the last day it was open.
         """
         return self.filter(
-            trade_date=F('cash__prices__day')).annotate(
-            exch=Sum(F('cash__prices__price'))
+            trade_date=F('cash__pricedetails__day')).annotate(
+            exch=Sum(F('cash__pricedetails__cadprice'))
         )
 
     def get_total_cad_by_group(self, columns):
-        return self.order_by().filter(trade_date=F('cash__prices__day')).annotate(
-            net_amount_cad=F('net_amount') * F('cash__prices__price')
+        return self.order_by().filter(trade_date=F('cash__pricedetails__day')).annotate(
+            net_amount_cad=F('net_amount') * F('cash__pricedetails__cadprice')
         ).annotate(_total_cad=Sum('net_amount_cad')).values(
             *columns, '_total_cad'
         ).annotate(total_cad=F('_total_cad')).values_list(*columns, 'total_cad')
@@ -274,10 +282,10 @@ class Activity(models.Model):
         Returns a map from symbol to amount for each security that is affected by this activity.
         """
         effects = {}
-        if self.cash:
-            effects[self.cash.symbol] = self.net_amount
-        if self.security and self.type != Activity.Type.Dividend:
-            effects[self.security.symbol] = self.qty
+        if self.cash_id:
+            effects[self.cash_id] = self.net_amount
+        if self.security_id and self.type != Activity.Type.Dividend:
+            effects[self.security_id] = self.qty
         return effects
 
 
@@ -362,7 +370,7 @@ class CostBasis(Activity):
     def post_initialize(self, previous_costbasis):
         self.cad_commission = self.commission * self.exch
         if not self.price:
-            self.price = self.security.prices.get(day=self.trade_date).price
+            self.price = self.security.pricedetails.get(day=self.trade_date).price
         self.cad_price_per_share = self.price * self.exch
         self.total_cad_value = self.qty * self.cad_price_per_share - self.cad_commission
 
@@ -1,15 +1,34 @@
 import datetime
+import json
+from collections import defaultdict
 from decimal import Decimal
+from itertools import groupby
 
-from django.db import models, connection
-from django.db.models import Sum
+from django.core.cache import cache
+from django.db import models, connection, transaction
+from django.db.models import Q, Sum
+from django_redis import get_redis_connection
 
 import utils.dates
+from utils.db import drop_relation
 from securities.models import MissingPriceException
 from securities.models import Security, SecurityPriceDetail, SecurityPriceQuerySet
 from .account import BaseAccount
 
 
+# Redis keys used to coalesce HoldingDetail.QueueRefresh requests.
+REFRESH_PENDING_KEY = 'holdingrefresh:pending'
+REFRESH_SCHEDULED_KEY = 'holdingrefresh:scheduled'
+REFRESH_LOCK_KEY = 'holdingrefresh:lock'
+REFRESH_REQUESTED_KEY = 'holdingrefresh:requested'
+REFRESH_EXECUTED_KEY = 'holdingrefresh:executed'
+REFRESH_COALESCE_SECONDS = 15
+REFRESH_LOCK_TIMEOUT = 30 * 60
+
+# Cache key of a counter bumped by every HoldingDetail.Refresh, for keying caches of data derived from holdings.
+CACHE_GENERATION_KEY = 'holdingdetail:generation:{}'
+
+
 class HoldingManager(models.Manager):
     def add_effect(self, account, symbol, qty_delta, date):
         qty_delta *= account.joint_share
@@ -36,6 +55,37 @@ class HoldingManager(models.Manager):
             self.create(account=account, security_id=symbol,
                         qty=new_qty, startdate=date, enddate=None)
 
+    def build_from_activities(self, account, activities, open_holdings=()):
+        """
+        Computes the holdings that result from a sequence of activities, entirely in memory.
+        Each day's effects are summed, then every security whose qty changed gets its open
+        holding closed the day before and a new one opened with the new qty.
+        :param activities: Activities of account, ordered by trade_date.
+        :param open_holdings: Holdings already open before the first activity. Their enddate
+                              is set in place if the activities close them.
+        :return: A list of the new, unsaved Holdings.
+        """
+        holdings = []
+        open_holdings = {h.security_id: h for h in open_holdings}
+        for day, day_activities in groupby(activities, lambda a: a.trade_date):
+            deltas = defaultdict(Decimal)
+            for activity in day_activities:
+                for symbol, qty_delta in activity.GetHoldingEffects().items():
+                    deltas[symbol] += qty_delta * account.joint_share
+
+            for symbol, qty_delta in deltas.items():
+                if not qty_delta:
+                    continue
+                previous = open_holdings.pop(symbol, None)
+                if previous:
+                    previous.enddate = day - datetime.timedelta(days=1)
+                new_qty = (previous.qty if previous else 0) + qty_delta
+                if new_qty:
+                    holding = Holding(account=account, security_id=symbol, qty=new_qty, startdate=day)
+                    open_holdings[symbol] = holding
+                    holdings.append(holding)
+        return holdings
+
 
 class HoldingQuerySet(models.query.QuerySet):
     def current(self):
@@ -107,6 +157,23 @@ class HoldingDetailQuerySet(SecurityPriceQuerySet):
     def total_values(self):
         return self.order_by('day').values_list('day').annotate(Sum('value'))
 
+    def value_at_date(self, day):
+        """
+        :return: The total value of the holdings on day, 0 if there are none.
+        """
+        return self.at_date(day).aggregate(total=Sum('value'))['total'] or 0
+
+    def value_between(self, start, end):
+        """
+        :return: A (start value, end value) tuple of the total value of the holdings on start and end, in one query.
+        """
+        totals = self.filter(day__in=(start, end)).aggregate(start=Sum('value', filter=Q(day=start)),
+                                                            end=Sum('value', filter=Q(day=end)))
+        return totals['start'] or 0, totals['end'] or 0
+
+    def account_total_values(self):
+        return self.order_by('day').values_list('account_id', 'day').annotate(Sum('value'))
+
     def today_security_values(self):
         return self.today().order_by('security_id').values_list('security_id').annotate(total=Sum('value'))
 
@@ -132,43 +199,181 @@ class HoldingDetail(models.Model):
 
     @classmethod
     def CreateView(cls):
+        """
+        Creates the financeview_holdingdetail table and fills it. It is kept up to date
+        incrementally by Refresh, so this only needs to run when the schema changes.
+        Safe to re-run, and replaces the materialized view this used to be.
+        """
         SecurityPriceDetail.CreateView(drop_cascading=True)
-        cursor = connection.cursor()
-        try:
+        with transaction.atomic(), connection.cursor() as cursor:
+            drop_relation(cursor, 'financeview_holdingdetail')
             cursor.execute("""
-DROP MATERIALIZED VIEW IF EXISTS financeview_holdingdetail;
-
-CREATE MATERIALIZED VIEW financeview_holdingdetail
-TABLESPACE pg_default
-AS
- SELECT h.account_id,
-    h.security_id,
-    p.day,
-    h.qty,
-    p.price,
-    p.exch,
-    p.cadprice AS cad,
-    p.cadprice * h.qty AS value,
-    row_number() OVER () AS id,
-    p.type
-   FROM finance_holding h
-     JOIN securities_cadview p ON h.security_id::text = p.security_id::text AND h.startdate <= p.day AND (p.day <= h.enddate OR h.enddate IS NULL)
-WITH DATA;
-
-ALTER TABLE financeview_holdingdetail OWNER TO financeuser;""")
-            connection.commit()
-        finally:
-            cursor.close()
+CREATE TABLE financeview_holdingdetail (
+    id serial PRIMARY KEY,
+    account_id integer NOT NULL,
+    security_id varchar(32) NOT NULL,
+    day date NOT NULL,
+    qty numeric(16, 6) NOT NULL,
+    price numeric(16, 6) NOT NULL,
+    exch numeric(16, 6) NOT NULL,
+    cad numeric(16, 6) NOT NULL,
+    value numeric(16, 6) NOT NULL,
+    type varchar(12) NOT NULL,
+    UNIQUE (account_id, security_id, day)
+);
+CREATE INDEX financeview_holdingdetail_day ON financeview_holdingdetail (day);
+CREATE INDEX financeview_holdingdetail_security_day ON financeview_holdingdetail (security_id, day);
+ALTER TABLE financeview_holdingdetail OWNER TO financeuser;
+""")
+            cls.Refresh()
 
     @classmethod
-    def Refresh(cls):
-        SecurityPriceDetail.Refresh()
-        cursor = connection.cursor()
-        try:
-            cursor.execute("REFRESH MATERIALIZED VIEW financeview_holdingdetail;")
-            connection.commit()
-        finally:
-            cursor.close()
+    def Refresh(cls, accounts=None, securities=None, start=None, end=None):
+        """
+        Recomputes the holding details in the given scope. Each argument narrows the scope,
+        and with no arguments everything is recomputed.
+        :param accounts: An iterable of account ids, or None for all accounts.
+        :param securities: An iterable of symbols, or None for all securities.
+                           A currency also includes every security priced in it.
+        :param start: A datetime.date, or None for no lower bound.
+        :param end: A datetime.date, or None for no upper bound.
+        """
+        conditions, params = ['TRUE'], {}
+        if accounts is not None:
+            conditions.append('{table}.account_id = ANY(%(accounts)s)')
+            params['accounts'] = list(accounts)
+        if securities is not None:
+            conditions.append("""{table}.security_id IN (
+                SELECT symbol FROM securities_security
+                WHERE symbol = ANY(%(symbols)s) OR currency = ANY(%(symbols)s))""")
+            params['symbols'] = list(securities)
+        if start:
+            conditions.append('{day} >= %(start)s')
+            params['start'] = start
+        if end:
+            conditions.append('{day} <= %(end)s')
+            params['end'] = end
+        where = ' AND '.join(conditions)
+
+        # Upsert what changed and delete what is gone in one statement, the same way as
+        # SecurityPriceDetail.Refresh, so pages reading holdings never wait on a refresh.
+        with connection.cursor() as cursor:
+            cursor.execute("""
+WITH fresh AS (
+    SELECT h.account_id,
+        h.security_id,
+        p.day,
+        h.qty,
+        p.price,
+        p.exch,
+        p.cadprice AS cad,
+        p.cadprice * h.qty AS value,
+        p.type
+        FROM finance_holding h
+            JOIN securities_cadview p ON h.security_id = p.security_id
+                AND h.startdate <= p.day AND (p.day <= h.enddate OR h.enddate IS NULL)
+        WHERE {fresh}
+), upserted AS (
+    INSERT INTO financeview_holdingdetail AS d (account_id, security_id, day, qty, price, exch, cad, value, type)
+    SELECT * FROM fresh
+    ON CONFLICT (account_id, security_id, day) DO UPDATE
+        SET qty = EXCLUDED.qty, price = EXCLUDED.price, exch = EXCLUDED.exch,
+            cad = EXCLUDED.cad, value = EXCLUDED.value, type = EXCLUDED.type
+        WHERE (d.qty, d.price, d.exch, d.cad, d.value, d.type) IS DISTINCT FROM
+            (EXCLUDED.qty, EXCLUDED.price, EXCLUDED.exch, EXCLUDED.cad, EXCLUDED.value, EXCLUDED.type)
+    RETURNING d.account_id
+), deleted AS (
+    DELETE FROM financeview_holdingdetail d
+        WHERE {stale}
+            AND NOT EXISTS (SELECT 1 FROM fresh f WHERE f.account_id = d.account_id
+                            AND f.security_id = d.security_id AND f.day = d.day)
+    RETURNING d.account_id
+)
+SELECT account_id FROM upserted UNION SELECT account_id FROM deleted;
+""".format(fresh=where.format(table='h', day='p.day'), stale=where.format(table='d', day='d.day')), params)
+            changed = [account_id for account_id, in cursor.fetchall()]
+        if changed:
+            transaction.on_commit(lambda: cls.InvalidateCaches(changed))
+
+    @classmethod
+    def CacheGeneration(cls, accounts):
+        """
+        :param accounts: An iterable of account ids.
+        :return: A string that changes whenever a refresh changes the holding details of any of the accounts,
+                 or the accounts themselves change. Put it in the key of anything cached from them.
+        """
+        accounts = sorted(accounts)
+        generations = cache.get_many([CACHE_GENERATION_KEY.format(account) for account in accounts])
+        return '-'.join('{}.{}'.format(account, generations.get(CACHE_GENERATION_KEY.format(account), 0))
+                        for account in accounts)
+
+    @classmethod
+    def InvalidateCaches(cls, accounts):
+        for account in accounts:
+            key = CACHE_GENERATION_KEY.format(account)
+            cache.add(key, 0, None)
+            cache.incr(key)
+
+    @classmethod
+    def RefreshSyncedPrices(cls, sync_results):
+        """
+        Recomputes the holding details affected by a price sync.
+        :param sync_results: The SecuritySyncResults returned from SecurityManager.Sync
+        """
+        by_range = defaultdict(list)
+        for result in sync_results:
+            if result.synced:
+                by_range[result.synced].append(result.symbol)
+        for (start, end), symbols in by_range.items():
+            cls.QueueRefresh(securities=symbols, start=start, end=end)
+
+    @classmethod
+    def QueueRefresh(cls, accounts=None, securities=None, start=None, end=None):
+        """
+        Requests a Refresh with the same arguments, to run in a RefreshHoldingDetailTask.
+        Every request that arrives before that task starts is coalesced into the same run.
+        """
+        from ..tasks import RefreshHoldingDetailTask
+        scope = {'accounts': sorted(accounts) if accounts is not None else None,
+                 'securities': sorted(securities) if securities is not None else None,
+                 'start': start.isoformat() if start else None,
+                 'end': end.isoformat() if end else None}
+        redis = get_redis_connection('default')
+        pipe = redis.pipeline()
+        pipe.rpush(REFRESH_PENDING_KEY, json.dumps(scope))
+        pipe.incr(REFRESH_REQUESTED_KEY)
+        pipe.set(REFRESH_SCHEDULED_KEY, 1, nx=True, ex=REFRESH_LOCK_TIMEOUT)
+        *_, newly_scheduled = pipe.execute()
+        if newly_scheduled:
+            RefreshHoldingDetailTask.apply_async(countdown=REFRESH_COALESCE_SECONDS)
+
+    @classmethod
+    def RunQueuedRefreshes(cls):
+        """
+        Runs every refresh queued by QueueRefresh, merged into as few Refresh calls as possible.
+        """
+        redis = get_redis_connection('default')
+        with redis.lock(REFRESH_LOCK_KEY, timeout=REFRESH_LOCK_TIMEOUT):
+            # Clear the flag first, so requests arriving while we work schedule another run.
+            pipe = redis.pipeline()
+            pipe.delete(REFRESH_SCHEDULED_KEY)
+            pipe.lrange(REFRESH_PENDING_KEY, 0, -1)
+            pipe.delete(REFRESH_PENDING_KEY)
+            _, pending, _ = pipe.execute()
+
+            scopes = coalesce_refresh_scopes(json.loads(scope.decode()) for scope in pending)
+            for scope in scopes:
+                cls.Refresh(**scope)
+            redis.incr(REFRESH_EXECUTED_KEY, len(scopes))
+
+    @classmethod
+    def RefreshStats(cls):
+        """
+        :return: A dict of how many refreshes were requested and how many actually ran.
+        """
+        redis = get_redis_connection('default')
+        requested, executed = redis.mget(REFRESH_REQUESTED_KEY, REFRESH_EXECUTED_KEY)
+        return {'requested': int(requested or 0), 'executed': int(executed or 0)}
 
     class Meta:
         managed = False
@@ -204,6 +409,32 @@ ALTER TABLE financeview_holdingdetail OWNER TO financeuser;""")
         return HoldingChange.create_delta(other, self)
 
 
+def coalesce_refresh_scopes(scopes):
+    """
+    Merges HoldingDetail.Refresh scopes (dicts of its keyword arguments, with isoformat dates).
+    Scopes over the same accounts and securities are merged into one covering all their dates,
+    and an unbounded scope swallows everything else.
+    :return: A list of dicts of keyword arguments for HoldingDetail.Refresh
+    """
+    merged = {}
+    for scope in scopes:
+        key = (tuple(scope['accounts']) if scope['accounts'] is not None else None,
+               tuple(scope['securities']) if scope['securities'] is not None else None)
+        start = scope['start'] and datetime.date(*map(int, scope['start'].split('-')))
+        end = scope['end'] and datetime.date(*map(int, scope['end'].split('-')))
+        if key in merged:
+            old_start, old_end = merged[key]
+            start = min(start, old_start) if start and old_start else None
+            end = max(end, old_end) if end and old_end else None
+        merged[key] = (start, end)
+
+    if merged.get((None, None)) == (None, None):
+        return [{'accounts': None, 'securities': None, 'start': None, 'end': None}]
+
+    return [{'accounts': accounts, 'securities': securities, 'start': start, 'end': end}
+            for (accounts, securities), (start, end) in merged.items()]
+
+
 class HoldingChange:
     def __init__(self, account=None, security=None, qty=Decimal(0), value=Decimal(0),
                  price=Decimal(0), day=None, exch=Decimal(1)):
@@ -2,6 +2,7 @@ import datetime
 
 import pendulum
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 from django.db.models import Sum
 from django.db.models.functions import ExtractYear
@@ -9,6 +10,7 @@ from django.db.models.functions import ExtractYear
 from securities.models import Security
 from utils.misc import xirr, total_return
 from . import Holding, HoldingDetail, BaseAccount, Activity, CostBasis
+from ..returns import PortfolioReturns
 
 
 class UserProfile(models.Model):
@@ -16,13 +18,15 @@ class UserProfile(models.Model):
     phone = models.CharField(max_length=32, null=True, blank=True)
     country = models.CharField(max_length=32, null=True, blank=True)
 
+    GROWTH_DATA_TTL = 24 * 60 * 60
+
     @property
     def username(self):
         return self.user.username
 
     @property
     def current_portfolio_value(self):
-        return sum(self.GetHoldingDetails().today()).value
+        return self.GetHoldingDetails().value_at_date(datetime.date.today())
 
     def GetHeldSecurities(self):
         return Security.objects.filter(pk__in=self.GetCurrentHoldings().values_list('security')).order_by('-type', 'symbol')
@@ -53,40 +57,80 @@ class UserProfile(models.Model):
         ).order_by().values('year').annotate(c=Sum('commission')).values_list('year', 'c'))
 
     def RateOfReturn(self, start, end, annualized=True):
+        """
+        :return: The rate of return between start and end in percent, or None if it has no solution.
+        """
         deposits = self.GetActivities().between(start + datetime.timedelta(days=1), end).get_all_deposits()
         dates, amounts = (list(zip(*deposits))) if deposits else ([], [])
 
-        start_value = sum(self.GetHoldingDetails().at_date(start)).value
-        end_value = sum(self.GetHoldingDetails().at_date(end)).value
+        start_value, end_value = self.GetHoldingDetails().value_between(start, end)
 
         all_dates = (start, *dates, end)
         all_values = (-start_value, *(-dep for dep in amounts), end_value)
         if abs(sum(all_values)) < 1: return 0
         f = xirr if annualized else total_return
-        return 100 * f(zip(all_dates, all_values))
+        try:
+            return 100 * f(zip(all_dates, all_values))
+        except ValueError:
+            return None
+
+    def GetReturns(self):
+        """
+        :return: A PortfolioReturns over this user's whole history, for computing many returns at once.
+        """
+        return PortfolioReturns(list(self.GetHoldingDetails().total_values()),
+                                list(self.GetActivities().get_all_deposits()))
 
     def AllRatesOfReturnFromInception(self, time_period='months'):
         """
         :param time_period: Can be 'days', 'weeks', 'months', 'years'.
-        :return:
+        :return: An iterator of (day, rate of return from inception to day).
         """
         inception = pendulum.Date.instance(self.GetInceptionDate())
         period = pendulum.today().date() - inception.add(days=3)
-        for day in period.range(time_period):
-            yield day, self.RateOfReturn(inception, day)
+        days = list(period.range(time_period))
+        rates = self.GetReturns().money_weighted([(inception, day) for day in days])
+        yield from zip(days, rates)
+
+    def GetAccountReturns(self):
+        """
+        :return: A dict of account -> PortfolioReturns over that account's whole history.
+        """
+        accounts = self.GetAccounts().in_bulk()
+        returns = PortfolioReturns.by_account(list(self.GetHoldingDetails().account_total_values()),
+                                              list(self.GetActivities().get_account_deposits()))
+        return {accounts[pk]: account_returns for pk, account_returns in returns.items() if pk in accounts}
 
-    def PeriodicRatesOfReturn(self, period_type='months'):
+    def GetPeriodRanges(self, period_type='months'):
+        """
+        :return: The (start, end) of each period since inception. The first and last periods are partial.
+                 Each period starts at the end of the one before, so their returns chain together.
+        """
         inception = pendulum.Date.instance(self.GetInceptionDate())
         period = pendulum.today().date() - inception.add(days=3)
         period_type_singular = period_type.rstrip('s')
-        for day in period.range(period_type, 1):
-            start = max(inception,
-                        day.start_of(period_type_singular))
-            end = min(pendulum.today().date(),
-                      day.end_of(period_type_singular))
-            ror = self.RateOfReturn(start, end, annualized=False)
-            print(start, end, ror)
-            yield end, ror
+        return [(max(inception, day.start_of(period_type_singular).subtract(days=1)),
+                 min(pendulum.today().date(), day.end_of(period_type_singular)))
+                for day in period.range(period_type, 1)]
+
+    def PeriodicRatesOfReturn(self, period_type='months', method='money_weighted'):
+        """
+        :param period_type: Can be 'days', 'weeks', 'months', 'years'.
+        :param method: 'money_weighted', 'time_weighted' or 'modified_dietz'.
+        :return: An iterator of (period end, total return over the period in percent).
+        """
+        ranges = self.GetPeriodRanges(period_type)
+        rates = self.GetReturns().period_returns(ranges, method)
+        yield from ((end, ror) for (start, end), ror in zip(ranges, rates))
+
+    def AccountPeriodicRatesOfReturn(self, period_type='months', method='time_weighted'):
+        """
+        :return: A dict of account -> list of (period end, total return over the period in percent).
+        """
+        ranges = self.GetPeriodRanges(period_type)
+        ends = [end for _, end in ranges]
+        return {account: list(zip(ends, returns.period_returns(ranges, method)))
+                for account, returns in self.GetAccountReturns().items()}
 
     def get_capital_gain_summary(self, symbol, acb_activities):
         security = Security.objects.get(symbol=symbol)
@@ -157,21 +201,18 @@ class UserProfile(models.Model):
         values: portfolio values on that date
         deposits: total $ deposited to date
         growth: total profit to date.
+        Cached until a refresh next changes the holding details of one of our accounts.
         """
-        days, values = list(zip(*self.GetHoldingDetails().total_values()))
-        dep_days, dep_amounts = map(list, list(zip(*self.GetActivities().get_all_deposits())))
-        next_dep = 0
-        deposits = []
-        for day in days:
-            while dep_days and dep_days[0] == day:
-                dep_days.pop(0)
-                next_dep += dep_amounts.pop(0)
-            else:
-                deposits.append(next_dep)
-
-        growth = [val - dep for val, dep in zip(values, deposits)]
-        ret_list = (days, values, deposits, growth)
-        return ret_list
+        generation = HoldingDetail.CacheGeneration(self.GetAccounts().values_list('id', flat=True))
+        key = 'growth_data:{}:{}'.format(self.user_id, generation)
+        data = cache.get(key)
+        if data is None:
+            returns = self.GetReturns()
+            deposits = returns.deposits_to_date(returns.days)
+            data = (returns.days.tolist(), returns.values.tolist(), deposits.tolist(),
+                    (returns.values - deposits).tolist())
+            cache.set(key, data, self.GROWTH_DATA_TTL)
+        return data
 
     def get_book_value_by_account_security(self, date):
         book_values = self.GetActivities().before(date).get_total_cad_by_group(('account', 'security'))
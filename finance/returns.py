@@ -0,0 +1,198 @@
+"""
+Rates of return over many date ranges, computed from series that are loaded from the database once.
+
+    returns = userprofile.GetReturns()
+    returns.money_weighted([(inception, day) for day in days])
+    returns.time_weighted(monthly_ranges)
+"""
+from collections import defaultdict
+
+import numpy
+from django.utils.functional import cached_property
+
+from utils.misc import xirr_batch
+
+
+def as_rates(array):
+    """ Converts an array of returns to a list of percentages, None where the return is undefined."""
+    return [None if numpy.isnan(rate) else 100 * float(rate) for rate in array]
+
+
+def link(rates):
+    """
+    Chains consecutive sub-period returns.
+    :param rates: A list of returns in percent, None counting as no change.
+    :return: The cumulative return in percent after each sub-period.
+    """
+    growth = numpy.cumprod([1 + (rate or 0) / 100 for rate in rates])
+    return as_rates(growth - 1)
+
+
+class PortfolioReturns:
+    def __init__(self, values, deposits):
+        """
+        :param values: (day, value) pairs of the total portfolio value, in date order.
+        :param deposits: (day, amount) pairs of money put in, negative for money taken out.
+        """
+        days, amounts = zip(*values) if values else ((), ())
+        self.days = numpy.array(days, dtype='datetime64[D]')
+        self.values = numpy.array(amounts, dtype=float)
+        self.deposits = sorted((day, float(amount)) for day, amount in deposits)
+        self.deposit_days = numpy.array([day for day, _ in self.deposits], dtype='datetime64[D]')
+
+    @classmethod
+    def by_account(cls, values, deposits):
+        """
+        :param values: (account, day, value) rows, in date order.
+        :param deposits: (account, day, amount) rows.
+        :return: A dict of account -> PortfolioReturns of just that account.
+        """
+        account_values, account_deposits = defaultdict(list), defaultdict(list)
+        for account, day, value in values:
+            account_values[account].append((day, value))
+        for account, day, amount in deposits:
+            account_deposits[account].append((day, amount))
+        return {account: cls(account_values[account], account_deposits[account])
+                for account in account_values.keys() | account_deposits.keys()}
+
+    @cached_property
+    def daily(self):
+        """
+        :return: Arrays of the value and the net deposits on every day from the first value to the last.
+                 Days without holdings are worth 0. Deposits outside those days are dropped.
+        """
+        if not len(self.days):
+            return numpy.zeros(0), numpy.zeros(0)
+        values = numpy.zeros((self.days[-1] - self.days[0]).astype(int) + 1)
+        values[(self.days - self.days[0]).astype(int)] = self.values
+        flows = numpy.zeros_like(values)
+        offsets = (self.deposit_days - self.days[0]).astype(int)
+        inside = (offsets >= 0) & (offsets < len(values))
+        numpy.add.at(flows, offsets[inside], numpy.array([amount for _, amount in self.deposits])[inside])
+        return values, flows
+
+    @cached_property
+    def growth(self):
+        """
+        :return: The growth of 1$ held since before the first day, with deposits taken out of each day's gain.
+                 Index 0 is before the first day, index n + 1 is the end of day n.
+        """
+        values, flows = self.daily
+        previous = numpy.concatenate(([0], values[:-1]))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            daily_growth = numpy.where(previous > 0, (values - flows) / previous, 1)
+        return numpy.concatenate(([1], numpy.cumprod(daily_growth)))
+
+    def prefix_index(self, days):
+        """
+        :return: For each day, the index into a prefix array over self.daily (like self.growth) of the end of that day.
+        """
+        if not len(self.days):
+            return numpy.zeros(len(days), dtype=int)
+        offsets = (numpy.array(days, dtype='datetime64[D]') - self.days[0]).astype(int)
+        return numpy.clip(offsets + 1, 0, len(self.daily[0]))
+
+    def values_at(self, days):
+        """
+        :param days: A numpy array of datetime64[D].
+        :return: The portfolio value on each day, 0 on days with no value.
+        """
+        if not len(self.days):
+            return numpy.zeros(len(days))
+        index = numpy.minimum(numpy.searchsorted(self.days, days), len(self.days) - 1)
+        return numpy.where(self.days[index] == days, self.values[index], 0)
+
+    def deposits_to_date(self, days):
+        """
+        :param days: A numpy array of datetime64[D].
+        :return: The total deposited on or before each day.
+        """
+        totals = numpy.concatenate(([0], numpy.cumsum([amount for _, amount in self.deposits])))
+        return totals[numpy.searchsorted(self.deposit_days, days, side='right')]
+
+    def cashflows(self, ranges):
+        """
+        :return: For each (start, end), the cashflows of holding the portfolio over that range:
+                 its start value in, the deposits after start in, and its end value out.
+        """
+        starts = numpy.array([start for start, _ in ranges], dtype='datetime64[D]')
+        ends = numpy.array([end for _, end in ranges], dtype='datetime64[D]')
+        first = numpy.searchsorted(self.deposit_days, starts, side='right')
+        last = numpy.searchsorted(self.deposit_days, ends, side='right')
+        return [[(start, -start_value), *((day, -amount) for day, amount in self.deposits[i:j]), (end, end_value)]
+                for (start, end), start_value, end_value, i, j
+                in zip(ranges, self.values_at(starts), self.values_at(ends), first, last)]
+
+    def money_weighted(self, ranges, annualized=True):
+        """
+        The equivalent of UserProfile.RateOfReturn for every range, solved in one batch.
+        :param ranges: A list of (start, end) dates.
+        :param annualized: If False, the total return over each range instead of the annual rate.
+        :return: A list of the rate of return over each range in percent, None where it has no solution.
+        """
+        if not ranges:
+            return []
+        cashflow_sets = self.cashflows(ranges)
+        rates, converged = xirr_batch(cashflow_sets)
+        results = []
+        for (start, end), cashflows, rate, ok in zip(ranges, cashflow_sets, rates, converged):
+            if abs(sum(amount for _, amount in cashflows)) < 1:
+                results.append(0)
+            elif not ok:
+                results.append(None)
+            elif annualized:
+                results.append(100 * float(rate))
+            else:
+                results.append(100 * (pow(1 + float(rate), (end - start).days / 365) - 1))
+        return results
+
+    def time_weighted(self, ranges):
+        """
+        The time-weighted return over each range, chained from daily returns so deposits don't count as gains.
+        :param ranges: A list of (start, end) dates.
+        :return: A list of the total return over each range in percent.
+        """
+        if not ranges:
+            return []
+        first = self.prefix_index([start for start, _ in ranges])
+        last = self.prefix_index([end for _, end in ranges])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return as_rates(self.growth[last] / self.growth[first] - 1)
+
+    def modified_dietz(self, ranges):
+        """
+        The Modified Dietz return over each range: the gain over the start value plus each deposit
+        weighted by the fraction of the range it was invested for.
+        :param ranges: A list of (start, end) dates.
+        :return: A list of the total return over each range in percent, None where nothing was invested.
+        """
+        if not ranges:
+            return []
+        _, flows = self.daily
+        offsets = numpy.arange(len(flows))
+        total_flows = numpy.concatenate(([0], numpy.cumsum(flows)))
+        total_flow_days = numpy.concatenate(([0], numpy.cumsum(flows * offsets)))
+
+        starts = numpy.array([start for start, _ in ranges], dtype='datetime64[D]')
+        ends = numpy.array([end for _, end in ranges], dtype='datetime64[D]')
+        first, last = self.prefix_index(starts), self.prefix_index(ends)
+        length = (ends - starts).astype(int)
+        # The deposits after the start day, and the same again multiplied by each deposit's day offset.
+        deposited = total_flows[last] - total_flows[first]
+        deposited_days = total_flow_days[last] - total_flow_days[first]
+        end_offsets = (ends - (self.days[0] if len(self.days) else ends)).astype(int)
+
+        start_values, end_values = self.values_at(starts), self.values_at(ends)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            weighted = (end_offsets * deposited - deposited_days) / length
+            rates = (end_values - start_values - deposited) / (start_values + weighted)
+        return as_rates(numpy.where(length > 0, rates, numpy.nan))
+
+    def period_returns(self, ranges, method='money_weighted'):
+        """
+        :param method: 'money_weighted', 'time_weighted' or 'modified_dietz'.
+        :return: A list of the total (not annualized) return over each range in percent.
+        """
+        if method == 'money_weighted':
+            return self.money_weighted(ranges, annualized=False)
+        return getattr(self, method)(ranges)
@@ -2,16 +2,18 @@ from datetime import date
 
 from django.contrib import messages
 
-from .models import Holding
+from securities.models import Security
 from .tasks import SyncSecurityTask
 
 
 def check_for_missing_securities(request):
-    current = Holding.objects.current().values_list('security_id').distinct()
-    num_prices = current.filter(security__prices__day=date.today()).count()
-    if current.count() > num_prices:
-        messages.warning(request, 'Currently updating out-of-date stock data. Please try again in a few seconds.'.format(num_prices, current.count()))
-        messages.debug(request, '{} of {} synced'.format(num_prices, current.count()))
+    # Prices are only stored for days the exchange is open, so up to date means having the last open day's.
+    current = list(Security.objects.filter(holdings__enddate__isnull=True).distinct().with_sync_ranges())
+    num_prices = sum(1 for s in current
+                     if s.latest_have and s.latest_have >= s.trading_calendar.previous_open(date.today()))
+    if len(current) > num_prices:
+        messages.warning(request, 'Currently updating out-of-date stock data. Please try again in a few seconds.')
+        messages.debug(request, '{} of {} synced'.format(num_prices, len(current)))
         SyncSecurityTask.delay(False)
 
 
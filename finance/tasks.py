@@ -3,18 +3,19 @@ from celery import shared_task
 
 @shared_task
 def SyncSecurityTask(live_update=True):
-    from securities.models import Security
+    from securities.models import Security, SecurityPriceDetail
     from .models import HoldingDetail
-    Security.objects.Sync(live_update)
-    HoldingDetail.Refresh()
+    results = Security.objects.Sync(live_update)
+    HoldingDetail.RefreshSyncedPrices(results)
+    start = SecurityPriceDetail.FillForward()
+    HoldingDetail.QueueRefresh(start=start)
 
 
 @shared_task
 def SyncActivityTask(userprofile=None):
-    from .models import BaseAccount, HoldingDetail
+    from .models import BaseAccount
     accounts = userprofile.GetAccounts() if userprofile else BaseAccount.objects.all()
     accounts.SyncAllActivitiesAndRegenerate()
-    HoldingDetail.Refresh()
 
 
 @shared_task
@@ -25,7 +26,12 @@ def DailyUpdateAll():
 
 @shared_task
 def HandleCsvUpload(accountcsv_id):
-    from .models import AccountCsv, HoldingDetail
+    from .models import AccountCsv
     a = AccountCsv.objects.get(pk=accountcsv_id)
     a.account.import_activities(a.csvfile)
-    HoldingDetail.Refresh()
+
+
+@shared_task
+def RefreshHoldingDetailTask():
+    from .models import HoldingDetail
+    HoldingDetail.RunQueuedRefreshes()
@@ -5,15 +5,27 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import SimpleTestCase, TestCase
+import threading
+import time
+from unittest import mock
+
+import numpy
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
 from django.urls import reverse
 from .urls import urlpatterns
 
 from datetime import date, timedelta
 from decimal import Decimal
-from .models import HoldingDetail, BaseAccount
+from .models import HoldingDetail, BaseAccount, BaseRawActivity, Holding, Activity, CostBasis, UserProfile
+from .models.holding import coalesce_refresh_scopes
+from .returns import PortfolioReturns, link
 from securities.models import Security, SecurityPriceDetail
 
+import utils.dates
+from utils.misc import xirr, xirr_batch
 from .templatetags import mytags
 
 
@@ -217,6 +229,287 @@ class HoldingChangeTestCase(TestCase):
         self.assertEqual(total_change.value_delta, change.value_delta+change2.value_delta+change3.value_delta)
 
 
+class BuildHoldingsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.account = BaseAccount(type='Test', account_id='123', joint_share=1)
+
+    def activity(self, day, symbol, qty, amount, type=Activity.Type.Buy):
+        return Activity(account=self.account, trade_date=day, security_id=symbol,
+                        cash_id='CAD', qty=qty, net_amount=amount, type=type)
+
+    def build(self, activities):
+        holdings = Holding.objects.build_from_activities(self.account, activities)
+        return [(h.security_id, h.qty, h.startdate, h.enddate) for h in holdings]
+
+    def test_buy_and_sell(self):
+        holdings = self.build([self.activity(date(2018, 1, 1), 'TSLA', 10, -100),
+                               self.activity(date(2018, 1, 5), 'TSLA', -10, 120)])
+        self.assertCountEqual(holdings, [('TSLA', 10, date(2018, 1, 1), date(2018, 1, 4)),
+                                    ('CAD', -100, date(2018, 1, 1), date(2018, 1, 4)),
+                                    ('CAD', 20, date(2018, 1, 5), None)])
+
+    def test_same_day_effects_combined(self):
+        holdings = self.build([self.activity(date(2018, 1, 1), 'TSLA', 10, -100),
+                               self.activity(date(2018, 1, 1), 'TSLA', 5, -50)])
+        self.assertCountEqual(holdings, [('TSLA', 15, date(2018, 1, 1), None),
+                                    ('CAD', -150, date(2018, 1, 1), None)])
+
+    def test_dividend_only_affects_cash(self):
+        holdings = self.build([self.activity(date(2018, 1, 1), 'TSLA', 0, 5, type=Activity.Type.Dividend)])
+        self.assertCountEqual(holdings, [('CAD', 5, date(2018, 1, 1), None)])
+
+    def test_carry_forward_open_holdings(self):
+        held = Holding(account=self.account, security_id='TSLA', qty=10, startdate=date(2018, 1, 1))
+        holdings = Holding.objects.build_from_activities(
+            self.account, [self.activity(date(2018, 2, 1), 'TSLA', 5, -50)], [held])
+        self.assertEqual(held.enddate, date(2018, 1, 31))
+        self.assertCountEqual([(h.security_id, h.qty, h.startdate, h.enddate) for h in holdings],
+                              [('TSLA', 15, date(2018, 2, 1), None), ('CAD', -50, date(2018, 2, 1), None)])
+
+    def test_joint_share(self):
+        self.account.joint_share = Decimal('0.5')
+        holdings = self.build([self.activity(date(2018, 1, 1), 'TSLA', 10, -100)])
+        self.assertCountEqual(holdings, [('TSLA', 5, date(2018, 1, 1), None),
+                                    ('CAD', -50, date(2018, 1, 1), None)])
+
+
+class RebuildHoldingsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.account = BaseAccount.objects.create(type='Test', account_id='321')
+        for day, qty in [(date(2018, 1, 1), 10), (date(2018, 1, 5), 5), (date(2018, 1, 10), -15)]:
+            Activity.objects.create(account=cls.account, raw=BaseRawActivity.objects.create(account=cls.account),
+                                    trade_date=day, security_id='TSLA', cash_id='USD', description='',
+                                    qty=qty, price=10, net_amount=-10 * qty, type=Activity.Type.Buy)
+
+    def holdings(self):
+        return list(self.account.holding_set.order_by('security_id', 'startdate').values_list(
+            'security_id', 'qty', 'startdate', 'enddate'))
+
+    def test_rebuild_from_trade_day(self):
+        self.account.BuildHoldings()
+        full = self.holdings()
+        self.account.BuildHoldings(date(2018, 1, 5))
+        self.assertEqual(self.holdings(), full)
+        self.assertIn(('TSLA', 15, date(2018, 1, 5), date(2018, 1, 9)), full)
+
+    def test_rebuild_from_quiet_day(self):
+        self.account.BuildHoldings()
+        full = self.holdings()
+        self.account.BuildHoldings(date(2018, 1, 7))
+        self.assertEqual(self.holdings(), full)
+
+    def test_rebuild_after_close(self):
+        self.account.BuildHoldings()
+        full = self.holdings()
+        self.account.BuildHoldings(date(2018, 1, 11))
+        self.assertEqual(self.holdings(), full)
+
+
+class CanadianHolidayTestCase(TestCase):
+    # Victoria Day: the NYSE is open but the Bank of Canada has no rate, so the last one is Friday's.
+    holiday = date(2018, 5, 21)
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = User.objects.create_user('holiday')
+        cls.account = BaseAccount.objects.create(type='Test', account_id='654', user=cls.user)
+        Security.objects.get(symbol='USD').prices.create(day=date(2018, 5, 18), price=Decimal('1.25'))
+        Security.objects.get(symbol='TSLA').prices.create(day=date(2018, 5, 18), price=200)
+        SecurityPriceDetail.Refresh(['USD', 'TSLA'], date(2018, 5, 18), cls.holiday)
+        Activity.objects.create(account=cls.account, raw=BaseRawActivity.objects.create(account=cls.account),
+                                trade_date=cls.holiday, security_id='TSLA', cash_id='USD', description='',
+                                qty=10, price=0, net_amount=-2000, type=Activity.Type.Buy)
+
+    def test_cost_basis(self):
+        [basis] = CostBasis.objects.get_capgains_table(self.user)
+        self.assertEqual(basis.exch, Decimal('1.25'))
+        self.assertEqual(basis.price, 200)
+        self.assertEqual(basis.acb_total, 2500)
+
+    def test_book_value(self):
+        book_values = Activity.objects.filter(account=self.account).get_total_cad_by_group(('account', 'security'))
+        self.assertEqual(list(book_values), [(self.account.id, 'TSLA', -2500)])
+
+
+class CoalesceRefreshScopesTestCase(SimpleTestCase):
+    def scope(self, accounts=None, securities=None, start=None, end=None):
+        return {'accounts': accounts, 'securities': securities, 'start': start, 'end': end}
+
+    def test_duplicates_merged(self):
+        scopes = coalesce_refresh_scopes([self.scope(accounts=[1]), self.scope(accounts=[1])])
+        self.assertEqual(scopes, [self.scope(accounts=(1,))])
+
+    def test_date_ranges_merged(self):
+        scopes = coalesce_refresh_scopes([self.scope(securities=['A'], start='2018-01-05', end='2018-01-06'),
+                                          self.scope(securities=['A'], start='2018-01-01', end='2018-01-02')])
+        self.assertEqual(scopes, [self.scope(securities=('A',), start=date(2018, 1, 1), end=date(2018, 1, 6))])
+
+    def test_unbounded_date_wins(self):
+        scopes = coalesce_refresh_scopes([self.scope(accounts=[1], start='2018-01-05'),
+                                          self.scope(accounts=[1])])
+        self.assertEqual(scopes, [self.scope(accounts=(1,))])
+
+    def test_full_refresh_swallows_all(self):
+        scopes = coalesce_refresh_scopes([self.scope(accounts=[1]), self.scope(),
+                                          self.scope(securities=['A'], start='2018-01-01')])
+        self.assertEqual(scopes, [self.scope()])
+
+    def test_distinct_scopes_kept(self):
+        scopes = coalesce_refresh_scopes([self.scope(accounts=[1]), self.scope(accounts=[2])])
+        self.assertEqual(len(scopes), 2)
+
+
+class FetchActivityWindowsTestCase(SimpleTestCase):
+    def test_windows_come_back_in_order(self):
+        account = BaseAccount()
+        account.activitySyncConcurrency = 4
+        periods = utils.dates.day_intervals(10, date(2018, 1, 1), date(2018, 4, 1))
+        release = threading.Event()
+
+        def fetch(start, end):
+            # The first window finishes last.
+            if start == periods[0].start:
+                release.wait(5)
+            else:
+                release.set()
+            return start
+
+        account.FetchActivities = fetch
+        self.assertEqual(list(account.FetchActivityWindows(periods)), [p.start for p in periods])
+
+    def test_failure_stops_fetching(self):
+        account = BaseAccount()
+        account.activitySyncConcurrency = 2
+        periods = utils.dates.day_intervals(10, date(2018, 1, 1), date(2018, 4, 1))
+        started, release = [], threading.Event()
+
+        def fetch(start, end):
+            started.append(start)
+            if start == periods[0].start:
+                raise ConnectionError('down')
+            release.wait(5)
+            return start
+
+        account.FetchActivities = fetch
+        began = time.perf_counter()
+        with self.assertRaises(ConnectionError):
+            list(account.FetchActivityWindows(periods))
+        # The error doesn't wait for the windows still being fetched, and the rest are never started.
+        self.assertLess(time.perf_counter() - began, 2)
+        release.set()
+        self.assertLess(len(started), len(periods))
+
+
+class XirrTestCase(SimpleTestCase):
+    # The example from the Excel XIRR documentation.
+    excel = [(date(2008, 1, 1), -10000), (date(2008, 3, 1), 2750), (date(2008, 10, 30), 4250),
+             (date(2009, 2, 15), 3250), (date(2009, 4, 1), 2750)]
+
+    def test_matches_excel(self):
+        self.assertAlmostEqual(xirr(self.excel), 0.373362535, places=7)
+
+    def test_order_doesnt_matter(self):
+        self.assertAlmostEqual(xirr(reversed(self.excel)), 0.373362535, places=7)
+
+    def test_batch_matches_single(self):
+        doubled = [(date(2018, 1, 1), Decimal('-100')), (date(2019, 1, 1), Decimal('200'))]
+        rates, converged = xirr_batch([self.excel, doubled])
+        self.assertTrue(converged.all())
+        self.assertAlmostEqual(rates[0], xirr(self.excel))
+        self.assertAlmostEqual(rates[1], 1)
+
+    def test_large_loss_falls_back(self):
+        # Newton starting from 10% overshoots below -100% here.
+        rates, converged = xirr_batch([[(date(2018, 1, 1), -100), (date(2019, 1, 1), 1)]])
+        self.assertTrue(converged[0])
+        self.assertAlmostEqual(rates[0], -0.99)
+
+    def test_no_solution_reported(self):
+        rates, converged = xirr_batch([[(date(2018, 1, 1), -100), (date(2018, 6, 1), -50)], []])
+        self.assertFalse(converged.any())
+        with self.assertRaises(ValueError):
+            xirr([(date(2018, 1, 1), -100), (date(2018, 6, 1), -50)])
+
+    def test_rate_of_return_without_solution(self):
+        # Everything lost with nothing taken out has no rate of return.
+        with mock.patch.object(UserProfile, 'GetActivities') as activities, \
+                mock.patch.object(UserProfile, 'GetHoldingDetails') as holdings:
+            activities.return_value.between.return_value.get_all_deposits.return_value = []
+            holdings.return_value.value_between.return_value = (100, 0)
+            profile = UserProfile()
+            self.assertIsNone(profile.RateOfReturn(date(2018, 1, 1), date(2019, 1, 1)))
+            self.assertIsNone(profile.RateOfReturn(date(2018, 1, 1), date(2019, 1, 1), annualized=False))
+
+
+class PortfolioReturnsTestCase(SimpleTestCase):
+    def setUp(self):
+        days = [date(2018, 1, 1) + timedelta(days=n) for n in range(366)]
+        # 1000 in on day one, another 1000 on July 1st, growing 10% over the year.
+        values = [(day, 1000 + 1000 * (day >= date(2018, 7, 1)) + 200 * n / 365) for n, day in enumerate(days)]
+        self.returns = PortfolioReturns(values, [(date(2018, 1, 1), Decimal(1000)), (date(2018, 7, 1), Decimal(1000))])
+
+    def test_matches_xirr(self):
+        start, end = date(2018, 1, 1), date(2019, 1, 1)
+        expected = xirr([(start, -1000), (date(2018, 7, 1), -1000), (end, 2200)])
+        self.assertAlmostEqual(self.returns.money_weighted([(start, end)])[0], 100 * expected)
+
+    def test_deposit_on_start_day_is_in_start_value(self):
+        cashflows = self.returns.cashflows([(date(2018, 7, 1), date(2018, 8, 1))])[0]
+        self.assertEqual(len(cashflows), 2)
+        self.assertAlmostEqual(cashflows[0][1], -2000 - 200 * 181 / 365)
+
+    def test_many_ranges(self):
+        ranges = [(date(2018, 1, 1), date(2018, month, 1)) for month in range(2, 13)]
+        rates = self.returns.money_weighted(ranges, annualized=False)
+        self.assertEqual(len(rates), 11)
+        self.assertAlmostEqual(rates[0], 100 * (200 * 31 / 365) / 1000)
+
+    def test_no_change_is_zero(self):
+        self.assertEqual(self.returns.money_weighted([(date(2018, 1, 1), date(2018, 1, 1))]), [0])
+
+    def test_deposits_to_date(self):
+        returns = PortfolioReturns([], [(date(2018, 1, 3), 5), (date(2018, 1, 1), 10), (date(2017, 12, 1), 1)])
+        days = numpy.array(['2017-11-30', '2018-01-01', '2018-01-02', '2018-01-03'], dtype='datetime64[D]')
+        self.assertEqual(list(returns.deposits_to_date(days)), [0, 11, 11, 16])
+
+    def test_missing_value_is_zero(self):
+        self.assertEqual(list(self.returns.values_at(numpy.array(['2017-12-31'], dtype='datetime64[D]'))), [0])
+
+
+class TimeWeightedReturnsTestCase(SimpleTestCase):
+    def setUp(self):
+        # 1000 grows 10% by July 1st, when another 1000 goes in, then everything grows 10% more.
+        july = date(2018, 7, 1)
+        values = [(day, 1000 * 1.1 ** ((day - date(2018, 1, 1)).days / 181) if day < july else
+                   2100 * 1.1 ** ((day - july).days / 183))
+                  for day in (date(2018, 1, 1) + timedelta(days=n) for n in range(365))]
+        self.returns = PortfolioReturns(values, [(date(2018, 1, 1), 1000), (july, 1000)])
+        self.months = [(max(date(2018, 1, 1), date(2018, month, 1) - timedelta(days=1)),
+                        date(2018 + month // 12, month % 12 + 1, 1) - timedelta(days=1)) for month in range(1, 13)]
+
+    def test_deposits_arent_gains(self):
+        rate, = self.returns.time_weighted([(date(2018, 1, 1), date(2018, 12, 31))])
+        self.assertAlmostEqual(rate, 21)
+
+    def test_monthly_twr_links_to_yearly(self):
+        self.assertAlmostEqual(link(self.returns.time_weighted(self.months))[-1], 21)
+
+    def test_monthly_dietz_links_to_yearly(self):
+        self.assertAlmostEqual(link(self.returns.modified_dietz(self.months))[-1], 21, places=1)
+
+    def test_dietz_empty_range(self):
+        self.assertEqual(self.returns.modified_dietz([(date(2018, 3, 1), date(2018, 3, 1))]), [None])
+
+    def test_by_account(self):
+        returns = PortfolioReturns.by_account([(1, date(2018, 1, 1), 100), (1, date(2018, 1, 2), 110)],
+                                              [(2, date(2018, 1, 1), 50)])
+        self.assertEqual(set(returns), {1, 2})
+        self.assertAlmostEqual(returns[1].time_weighted([(date(2018, 1, 1), date(2018, 1, 2))])[0], 10)
+
+
 class TemplateTagTestCase(SimpleTestCase):
     def test_normalize_1(self):
         self.assertEqual(mytags.normalize(Decimal('1.35'), 0, 2), '1.35')
@@ -285,3 +578,73 @@ class UrlTestCase(TestCase):
             with self.subTest(i=i):
                 response = self.client.get(reverse('finance:' + url.name))
                 self.assertEqual(response.status_code, 200)
+
+
+class HoldingDetailRefreshTestCase(TransactionTestCase):
+    """
+    A TransactionTestCase so a refresh on another thread really commits. The database is flushed
+    after every test, so each test makes its own security and prices rather than relying on
+    setUpModule. The detail tables are unmanaged and never flushed: they are created once, and
+    a full Refresh in setUp clears out whatever the last test left behind.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        HoldingDetail.CreateView()
+
+    def setUp(self):
+        security = Security.stocks.create(symbol='HDTEST', currency='CAD')
+        security.prices.create(day=date.today(), price=300)
+        security.prices.create(day=date.today() - timedelta(days=1), price=310)
+        self.account = BaseAccount.objects.create(type='Test', account_id='789')
+        Holding.objects.bulk_create([Holding(account=self.account, security_id='HDTEST', qty=10,
+                                             startdate=date.today() - timedelta(days=1))])
+        SecurityPriceDetail.Refresh()
+        HoldingDetail.Refresh()
+
+    def test_create_view_twice(self):
+        HoldingDetail.CreateView()
+        self.assertEqual(HoldingDetail.objects.filter(account=self.account).today().get().qty, 10)
+
+    def test_values_aggregated(self):
+        details = HoldingDetail.objects.filter(account=self.account)
+        yesterday = date.today() - timedelta(days=1)
+        self.assertEqual(details.value_at_date(date.today()), 3000)
+        self.assertEqual(details.value_at_date(yesterday - timedelta(days=1)), 0)
+        self.assertEqual(details.value_between(yesterday, date.today()), (3100, 3000))
+
+    def test_refresh_invalidates_caches(self):
+        other = BaseAccount.objects.create(type='Test', account_id='987')
+        generations = HoldingDetail.CacheGeneration([self.account.pk]), HoldingDetail.CacheGeneration([other.pk])
+        HoldingDetail.Refresh(accounts=[self.account.pk])
+        self.assertEqual(HoldingDetail.CacheGeneration([self.account.pk]), generations[0])
+
+        Holding.objects.filter(account=self.account).update(qty=20)
+        HoldingDetail.Refresh()
+        self.assertNotEqual(HoldingDetail.CacheGeneration([self.account.pk]), generations[0])
+        self.assertEqual(HoldingDetail.CacheGeneration([other.pk]), generations[1])
+
+    def refresh_and_wait(self, refreshed, release):
+        try:
+            with transaction.atomic():
+                Holding.objects.filter(account=self.account).update(qty=20)
+                HoldingDetail.Refresh(accounts=[self.account.pk])
+                refreshed.set()
+                release.wait(10)
+        finally:
+            connection.close()
+
+    def test_reader_not_blocked_by_refresh(self):
+        refreshed, release = threading.Event(), threading.Event()
+        thread = threading.Thread(target=self.refresh_and_wait, args=(refreshed, release))
+        thread.start()
+        try:
+            self.assertTrue(refreshed.wait(10))
+            with connection.cursor() as cursor:
+                cursor.execute("SET lock_timeout = '1s';")
+            # The refresh hasn't committed, so we see the old rows without waiting for it.
+            self.assertEqual(HoldingDetail.objects.filter(account=self.account).today().get().qty, 10)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(HoldingDetail.objects.filter(account=self.account).today().get().qty, 20)
@@ -11,6 +11,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
+from django.db.models import OuterRef, Subquery
 from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.shortcuts import render, HttpResponseRedirect
@@ -24,7 +25,7 @@ from django.views.generic.edit import FormView, UpdateView
 from charts.models import GrowthChart, RebalancePieChart, SecurityChart
 from charts.views import HighChartMixin
 from securities.models import MissingPriceException
-from securities.models import Security
+from securities.models import Security, SecurityPrice
 from utils.misc import partition
 from .forms import FeedbackForm, AccountCsvForm, ProfileInlineFormset
 from .forms import UserForm
@@ -102,25 +103,28 @@ class AdminSecurity(RefreshButtonHandlerMixin, ListView):
             elif symbol == 'active':
                 Security.objects.Sync(True)
             else:
-                security = Security.objects.get(pk=symbol)
-                security.SyncRates(True)
+                Security.objects.get(pk=symbol).SyncRates(True)
+                security = self.annotate_sync_state(self.get_base_queryset().filter(pk=symbol))[0]
                 return render(request, 'finance/admin/securityrow.html', {'security': security})
         return HttpResponse()
 
-    def get_queryset(self):
-        securities = self.model.objects.all().prefetch_related('activities', 'prices', 'datasources').order_by('-type', 'symbol')
+    def get_base_queryset(self):
+        latest_price = SecurityPrice.objects.filter(security=OuterRef('pk')).order_by('-day').values('price')[:1]
+        return self.model.objects.with_sync_ranges().annotate(
+            current_price=Subquery(latest_price)).prefetch_related('datasources')
+
+    @staticmethod
+    def annotate_sync_state(securities):
+        securities = list(securities)
         for s in securities:
-            try:
-                s.earliest_have = s.prices.earliest().day
-                s.latest_price = s.prices.latest()
-                s.latest_have = s.latest_price.day
+            if s.earliest_have is not None:
                 s.need_sync_earlier = (s.earliest_have >= s.earliest_price_needed)
                 s.need_sync_later = (s.latest_have < s.latest_price_needed)
-                s.current_price = s.latest_price.price
-            except:
-                pass
         return securities
 
+    def get_queryset(self):
+        return self.annotate_sync_state(self.get_base_queryset().order_by('-type', 'symbol'))
+
 
 @method_decorator(never_cache, 'dispatch')
 class UserProfileView(LoginRequiredMixin, UpdateView):
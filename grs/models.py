@@ -125,16 +125,19 @@ class GrsAccount(BaseAccount):
     def __repr__(self):
         return 'GrsAccount<{},{},{}>'.format(self.client, self.account_id, self.type)
 
-    def CreateActivities(self, start, end):
+    def FetchActivities(self, start, end):
         with self.client as client:
-            for day, desc, _, price, qty in client.GetActivities(self, start, end):
-                # TODO: Hacking the symbol here to the only one I buy. I have the description in
-                # TODO: <TD class='activities-sh2'>Canadian Equity (Leith Wheeler)-Employer</TD>
-                # TODO: Create the security with that description and then do a lookup here.
-                GrsRawActivity.objects.create(
-                    account=self, day=parser.parse(day).date(),
-                    qty=Decimal(qty), price=Decimal(price),
-                    symbol='BJP', description=desc)
+            return list(client.GetActivities(self, start, end))
+
+    def SaveActivities(self, fetched):
+        for day, desc, _, price, qty in fetched:
+            # TODO: Hacking the symbol here to the only one I buy. I have the description in
+            # TODO: <TD class='activities-sh2'>Canadian Equity (Leith Wheeler)-Employer</TD>
+            # TODO: Create the security with that description and then do a lookup here.
+            GrsRawActivity.objects.create(
+                account=self, day=parser.parse(day).date(),
+                qty=Decimal(qty), price=Decimal(price),
+                symbol='BJP', description=desc)
 
 
 class GrsDataSource(DataSourceMixin):
@@ -143,6 +146,8 @@ class GrsDataSource(DataSourceMixin):
     plan_data = models.CharField(max_length=100)
     MAX_SYNC_DAYS = 15
 
+    provider = 'grs'
+
     def __str__(self):
         return "GRS Client {} for symbol {} ({}".format(self.client, self.symbol, self.priority)
 
@@ -101,6 +101,20 @@ CACHES = {
     }
 }
 
+# Raw datasource responses, see datasource/cache.py.
+# Shared through Redis by default, or set DATASOURCE_CACHE_DIR to keep them on local disk.
+DATASOURCE_CACHE_DIR = config('DATASOURCE_CACHE_DIR', default='')
+if DATASOURCE_CACHE_DIR:
+    CACHES['datasource'] = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": DATASOURCE_CACHE_DIR,
+        "OPTIONS": {
+            "MAX_ENTRIES": 2000,
+        }
+    }
+else:
+    CACHES['datasource'] = dict(CACHES['default'], KEY_PREFIX='datasource')
+
 CACHE_MIDDLEWARE_ALIAS = 'default'
 CACHE_MIDDLEWARE_SECONDS = 5 * 60
 CACHE_MIDDLEWARE_KEY_PREFIX = ''
@@ -1,14 +1,20 @@
 import datetime
 import threading
 from decimal import Decimal
+from itertools import groupby
 from json import dumps, loads, JSONDecodeError
+from operator import attrgetter
 
+import pandas
 import pendulum
 import requests
 from dateutil import parser
+from django.core.cache import cache
 from django.db import models, transaction
 from django.utils import timezone
+from django_redis import get_redis_connection
 
+from datasource.breaker import SourceError
 from datasource.models import DataSourceMixin
 from finance.models import Activity
 from finance.models import BaseRawActivity, BaseAccount, ManualRawActivity
@@ -134,6 +140,15 @@ class QuestradeRawActivity(BaseRawActivity):
         Activity.objects.create(**create_args)
 
 
+# One keep-alive session per client in each thread, since requests.Session isn't thread-safe.
+class ThreadSessions(threading.local):
+    def __init__(self):
+        self.sessions = {}
+
+
+_thread_sessions = ThreadSessions()
+
+
 class QuestradeClient(models.Model):
     username = models.CharField(max_length=32)
     refresh_token = models.CharField(max_length=100)
@@ -142,6 +157,14 @@ class QuestradeClient(models.Model):
     token_expiry = models.DateTimeField(null=True, blank=True)
     authorization_lock = threading.Lock()
 
+    # The most options we ask for in one quotes request.
+    OPTION_QUOTE_BATCH = 100
+    # Symbol IDs never change. Option chains gain strikes and expiries, so don't keep them as long.
+    SYMBOL_ID_TTL = 30 * 24 * 60 * 60
+    OPTION_CHAIN_TTL = 24 * 60 * 60
+    # An expiry the underlying doesn't have is remembered for less time, in case it gets listed.
+    OPTION_CHAIN_MISS_TTL = 60 * 60
+
     def __str__(self):
         return self.username
 
@@ -153,7 +176,8 @@ class QuestradeClient(models.Model):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.session.close()
+        # The session is kept open for this thread's next caller.
+        pass
 
     @property
     def needs_refresh(self):
@@ -161,12 +185,41 @@ class QuestradeClient(models.Model):
         if not self.token_expiry: return True
         if not self.access_token: return True
         # We need refresh if we are less than 10 minutes from expiry.
-        return self.token_expiry < (timezone.now() - datetime.timedelta(seconds=600))
+        return self.token_expiry < (timezone.now() + datetime.timedelta(seconds=600))
+
+    @property
+    def token_key(self):
+        return 'questrade:token:{}'.format(self.pk)
+
+    def _LoadToken(self):
+        """ Loads the current token from Redis, so we don't need to reload our row from the database."""
+        state = get_redis_connection('default').hgetall(self.token_key)
+        if state:
+            self.access_token = state[b'access_token'].decode()
+            self.api_server = state[b'api_server'].decode()
+            self.token_expiry = datetime.datetime.fromtimestamp(float(state[b'expiry']), tz=datetime.timezone.utc)
+
+    def _StoreToken(self):
+        with get_redis_connection('default').pipeline() as pipe:
+            # One field at a time: hmset is deprecated, and the pinned redis-py predates hset(mapping=...).
+            for field, value in [('access_token', self.access_token), ('api_server', self.api_server),
+                                 ('expiry', self.token_expiry.timestamp())]:
+                pipe.hset(self.token_key, field, value)
+            pipe.expireat(self.token_key, int(self.token_expiry.timestamp()))
+            pipe.execute()
 
     @classmethod
-    def UpdateAccessToken(cls, pk):
+    def UpdateAccessToken(cls, pk, force=False, rejected_token=None):
+        """
+        :param force: Get a new token even if the current one hasn't expired.
+        :param rejected_token: A token the server refused. Only replaced if it is still the current one.
+        """
         with transaction.atomic():
             client = cls.objects.select_for_update().get(pk=pk)
+            if not force and not client.needs_refresh and client.access_token != rejected_token:
+                # Another worker refreshed it while we waited for the lock.
+                client._StoreToken()
+                return
             _URL_LOGIN = 'https://login.questrade.com/oauth2/token?grant_type=refresh_token&refresh_token='
             r = requests.get(_URL_LOGIN + client.refresh_token)
             r.raise_for_status()
@@ -177,29 +230,44 @@ class QuestradeClient(models.Model):
                 client.access_token = json['access_token']
                 client.token_expiry = timezone.now() + datetime.timedelta(seconds=json['expires_in'])
                 client.save()
+                client._StoreToken()
             except JSONDecodeError:
                 print("Failed to get a valid Questrade access token for {}.".format(client))
                 print("The request result was {}".format(r.content))
                 raise ConnectionError()
 
-    def Authorize(self, force=False):
+    def Authorize(self, force=False, rejected_token=None):
         assert self.refresh_token, "We don't have a refresh_token at all! How did that happen?"
-        if self.needs_refresh or force:
-            self.UpdateAccessToken(self.pk)
-            self.refresh_from_db()
-
-        self.session = requests.Session()
-        self.session.headers.update({'Authorization': 'Bearer' + ' ' + self.access_token})
-
-    def _GetRequest(self, url, params=None):
-        r = self.session.get(self.api_server + url, params=params)
+        with self.authorization_lock:
+            self._LoadToken()
+            if self.needs_refresh or force or self.access_token == rejected_token:
+                self.UpdateAccessToken(self.pk, force, rejected_token)
+                self.refresh_from_db()
+
+    def GetSession(self):
+        """ This thread's keep-alive session for this client."""
+        session = _thread_sessions.sessions.get(self.pk)
+        if session is None:
+            session = _thread_sessions.sessions[self.pk] = requests.Session()
+        return session
+
+    def _Request(self, method, url, **kwargs):
+        token = self.access_token
+        r = self.GetSession().request(method, self.api_server + url,
+                                      headers={'Authorization': 'Bearer ' + token}, **kwargs)
+        if r.status_code == 401:
+            # The token was revoked or expired early, so get a new one, unless another thread already has.
+            self.Authorize(rejected_token=token)
+            r = self.GetSession().request(method, self.api_server + url,
+                                          headers={'Authorization': 'Bearer ' + self.access_token}, **kwargs)
         r.raise_for_status()
         return r.json()
 
+    def _GetRequest(self, url, params=None):
+        return self._Request('get', url, params=params)
+
     def _PostRequest(self, url, data=None, json=None):
-        r = self.session.post(self.api_server + url, data=data, json=json)
-        r.raise_for_status()
-        return r.json()
+        return self._Request('post', url, data=data, json=json)
 
     @api_response('accounts')
     def GetAccounts(self):
@@ -212,7 +280,36 @@ class QuestradeClient(models.Model):
             yield entry['symbolId']
 
     def GetSymbolId(self, symbol):
-        return next(self.GetSymbolIds([symbol]))
+        key = 'questrade:symbolid:{}'.format(symbol)
+        symbol_id = cache.get(key)
+        if symbol_id is None:
+            symbol_id = next(self.GetSymbolIds([symbol]))
+            cache.set(key, symbol_id, self.SYMBOL_ID_TTL)
+        return symbol_id
+
+    def GetOptionChain(self, underlying_id, expiry):
+        """
+        :param underlying_id: the Questrade ID of the underlying
+        :param expiry: datetime.date, expiry date
+        :return: A list of (strike, call id, put id) for that expiry, or None if there is no such expiry.
+        """
+        key = 'questrade:optionchain:{}:{}'.format(underlying_id, expiry)
+        chain = cache.get(key)
+        if chain is None:
+            # The chain comes back for every expiry at once, so keep them all.
+            chain_json = self._GetRequest('symbols/{}/options'.format(underlying_id))
+            chains = {}
+            for chain_entry in chain_json['optionChain']:
+                day = parser.parse(chain_entry['expiryDate']).date()
+                chains['questrade:optionchain:{}:{}'.format(underlying_id, day)] = [
+                    (option['strikePrice'], option['callSymbolId'], option['putSymbolId'])
+                    for root in chain_entry['chainPerRoot'] for option in root['chainPerStrikePrice']]
+            cache.set_many(chains, self.OPTION_CHAIN_TTL)
+            chain = chains.get(key)
+            if chain is None:
+                # Cache the miss too, as False since None means not cached.
+                cache.set(key, False, self.OPTION_CHAIN_MISS_TTL)
+        return None if chain is False else chain
 
     def GetOptionId(self, underlying_id, expiry, type, strike):
         """
@@ -222,19 +319,27 @@ class QuestradeClient(models.Model):
         :param strike: strike price
         :return:
         """
-        chain_json = self._GetRequest('symbols/{}/options'.format(underlying_id))
-        for chain in chain_json['optionChain']:
-            if parser.parse(chain['expiryDate']).date() == expiry.date():
-                for root in chain['chainPerRoot']:
-                    for option in root['chainPerStrikePrice']:
-                        if abs(option['strikePrice'] - strike) < 0.01:
-                            return option[type.lower() + 'SymbolId']
+        for chain_strike, call_id, put_id in self.GetOptionChain(underlying_id, expiry.date()) or []:
+            if abs(chain_strike - strike) < 0.01:
+                return call_id if type.lower() == 'call' else put_id
         return 0
 
+    def GetOptionQuotes(self, option_ids):
+        """
+        :param option_ids: An iterable of Questrade option IDs.
+        :return: A dict of option ID -> last price, for every option that was quoted.
+        """
+        option_ids = list(option_ids)
+        prices = {}
+        for i in range(0, len(option_ids), self.OPTION_QUOTE_BATCH):
+            json = self._PostRequest('markets/quotes/options',
+                                     json={'optionIds': option_ids[i:i + self.OPTION_QUOTE_BATCH]})
+            for data in json['optionQuotes']:
+                prices[data['symbolId']] = data['lastTradePriceTrHrs'] or data['lastTradePrice']
+        return prices
+
     def GetOptionPrice(self, option_id):
-        json = self._PostRequest('markets/quotes/options', json={'optionIds': [option_id]})
-        data = json['optionQuotes'][0]
-        return data['lastTradePriceTrHrs'] or data['lastTradePrice']
+        return self.GetOptionQuotes([option_id])[option_id]
 
     @api_response()
     def GetAccountBalances(self, id):
@@ -266,6 +371,8 @@ class QuestradeOptionDataSource(DataSourceMixin):
     optionid = models.IntegerField()
     client = models.ForeignKey(QuestradeClient, on_delete=models.CASCADE)
 
+    provider = 'questrade'
+
     def __str__(self):
         return "Questrade Option Datasource {} for option {} ({})".format(self.client, self.symbol, self.priority)
 
@@ -281,6 +388,31 @@ class QuestradeOptionDataSource(DataSourceMixin):
         return cls.objects.create(symbol=option.symbol, optionid=optionid, client=client,
                                   priority=cls.PRIORITY_REALTIME)
 
+    @classmethod
+    def RetrieveMany(cls, sources, start, end):
+        """
+        Quotes every option of each client together, with one authorization and as few requests as possible.
+        :return: A dict of source pk -> pandas.Series
+        """
+        multipliers = {option.symbol: option.price_multiplier
+                       for option in Security.options.filter(symbol__in=[s.symbol for s in sources])}
+        today = pandas.DatetimeIndex([datetime.date.today()])
+        retrieved = {}
+        for _, client_sources in groupby(sorted(sources, key=attrgetter('client_id')), key=attrgetter('client_id')):
+            client_sources = list(client_sources)
+            try:
+                with client_sources[0].client as client:
+                    prices = client.GetOptionQuotes(s.optionid for s in client_sources)
+            except (SourceError, requests.RequestException, ConnectionError) as e:
+                # Leave this client's sources out, so they are asked for one at a time instead.
+                print('Skipping option quotes from {}: {}'.format(client_sources[0].client, e))
+                continue
+            for source in client_sources:
+                if prices.get(source.optionid) is not None and source.symbol in multipliers:
+                    retrieved[source.pk] = pandas.Series([multipliers[source.symbol] * prices[source.optionid]],
+                                                         index=today)
+        return retrieved
+
     def _Retrieve(self, start, end):
         try:
             with self.client as client:
@@ -297,6 +429,8 @@ class QuestradeAccount(BaseAccount):
     sodBalanceSynced = models.DecimalField(max_digits=19, decimal_places=4, default=0)
 
     activitySyncDateRange = 28
+    # Well under Questrade's per-second limit on account calls.
+    activitySyncConcurrency = 4
 
     def __str__(self):
         return "{} {} {}".format(self.client, self.account_id, self.type)
@@ -312,7 +446,11 @@ class QuestradeAccount(BaseAccount):
     def yesterday_balance(self):
         return self.sodBalanceSynced
 
-    def CreateActivities(self, start, end):
-        with self.client as client:
-            for json in client.GetActivities(self.account_id, start, end):
-                QuestradeRawActivity.objects.get_or_create(account=self, jsonstr=dumps(json))
+    def FetchActivities(self, start, end):
+        # FetchActivityWindows calls this from several threads, so each call gets its own client.
+        with QuestradeClient.objects.get(pk=self.client_id) as client:
+            return client.GetActivities(self.account_id, start, end)
+
+    def SaveActivities(self, fetched):
+        for json in fetched:
+            QuestradeRawActivity.objects.get_or_create(account=self, jsonstr=dumps(json))
@@ -1,2 +1,71 @@
+import datetime
+from unittest import mock
 
+import requests
+from django.core.cache import cache
+from django.test import SimpleTestCase
+from django.utils import timezone
 
+from questrade.models import QuestradeClient, QuestradeOptionDataSource
+
+
+class RejectedTokenTestCase(SimpleTestCase):
+    def setUp(self):
+        self.questrade = QuestradeClient(pk=1, refresh_token='refresh', access_token='old', api_server='https://api/')
+        self.session = mock.Mock()
+        self.session.request.side_effect = [mock.Mock(status_code=401), mock.Mock(status_code=200)]
+
+    def request(self, stored_token):
+        def load(client):
+            client.access_token = stored_token
+            client.token_expiry = timezone.now() + datetime.timedelta(hours=1)
+
+        with mock.patch.object(QuestradeClient, '_LoadToken', load), \
+                mock.patch.object(QuestradeClient, 'GetSession', return_value=self.session), \
+                mock.patch.object(QuestradeClient, 'UpdateAccessToken') as update, \
+                mock.patch.object(QuestradeClient, 'refresh_from_db'):
+            self.questrade._Request('get', 'accounts')
+        return update
+
+    def test_rejected_token_is_refreshed(self):
+        update = self.request(stored_token='old')
+        update.assert_called_once_with(1, False, 'old')
+
+    def test_token_already_replaced_by_another_thread(self):
+        update = self.request(stored_token='new')
+        update.assert_not_called()
+        self.assertEqual(self.session.request.call_args[1]['headers'], {'Authorization': 'Bearer new'})
+
+
+class OptionPrefetchTestCase(SimpleTestCase):
+    def test_failing_client_is_skipped(self):
+        good, bad = QuestradeClient(pk=1, refresh_token='good'), QuestradeClient(pk=2, refresh_token='bad')
+        sources = [QuestradeOptionDataSource(pk=10, symbol='GOOD', optionid=100, client=good),
+                   QuestradeOptionDataSource(pk=20, symbol='BAD', optionid=200, client=bad)]
+
+        def quotes(client, option_ids):
+            if client is bad:
+                raise requests.Timeout()
+            return {option_id: 2 for option_id in option_ids}
+
+        with mock.patch.object(QuestradeClient, 'Authorize'), \
+                mock.patch.object(QuestradeClient, 'GetOptionQuotes', autospec=True, side_effect=quotes), \
+                mock.patch('questrade.models.Security.options') as options:
+            options.filter.return_value = [mock.Mock(symbol='GOOD', price_multiplier=100),
+                                           mock.Mock(symbol='BAD', price_multiplier=100)]
+            retrieved = QuestradeOptionDataSource.RetrieveMany(sources, datetime.date.today(), datetime.date.today())
+        self.assertEqual(list(retrieved), [10])
+        self.assertEqual(list(retrieved[10]), [200])
+
+
+class OptionChainTestCase(SimpleTestCase):
+    def test_missing_expiry_is_cached(self):
+        questrade = QuestradeClient(pk=1)
+        chain_json = {'optionChain': [{'expiryDate': '2018-01-19T00:00:00.000000-05:00', 'chainPerRoot': [
+            {'chainPerStrikePrice': [{'strikePrice': 10, 'callSymbolId': 1, 'putSymbolId': 2}]}]}]}
+        cache.delete_many(['questrade:optionchain:99:2018-01-19', 'questrade:optionchain:99:2018-02-16'])
+        with mock.patch.object(QuestradeClient, '_GetRequest', return_value=chain_json) as request:
+            for _ in range(2):
+                self.assertIsNone(questrade.GetOptionChain(99, datetime.date(2018, 2, 16)))
+            self.assertEqual(questrade.GetOptionChain(99, datetime.date(2018, 1, 19)), [(10, 1, 2)])
+        self.assertEqual(request.call_count, 1)
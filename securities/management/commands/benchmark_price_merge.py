@@ -0,0 +1,64 @@
+"""
+Compares the bulk INSERT ... ON CONFLICT price merge against the old row-at-a-time loop.
+
+Usage: manage.py benchmark_price_merge [--years 10]
+
+Everything runs inside a transaction that is rolled back, so no data is left behind.
+"""
+import datetime
+import time
+
+import numpy
+import pandas
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from datasource.models import DataSourceMixin
+from securities.models import Security
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark Security.MergePrices against Security.MergePricesIterative.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, default=10)
+
+    def make_frame(self, years, priority):
+        index = pandas.date_range(end=datetime.date.today(), periods=365 * years, freq='D').date
+        prices = numpy.round(numpy.random.uniform(10, 100, len(index)), 6)
+        return pandas.DataFrame({'price': prices, 'priority': float(priority)},
+                                index=index, columns=['price', 'priority'])
+
+    def run_case(self, merge_fn, frame, prefill=None):
+        try:
+            with transaction.atomic():
+                security = Security(symbol='BENCHMARK', currency='CAD', type=Security.Type.Stock)
+                security.save()
+                if prefill is not None:
+                    security.MergePrices(prefill)
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    merge_fn(security, frame)
+                    elapsed = time.perf_counter() - start
+                raise Rollback
+        except Rollback:
+            pass
+        return elapsed, len(queries)
+
+    def handle(self, *args, **options):
+        years = options['years']
+        frame = self.make_frame(years, DataSourceMixin.PRIORITY_DAILY)
+        existing = self.make_frame(years, DataSourceMixin.PRIORITY_LOW)
+        cases = [('empty history', None), ('full history', existing)]
+        methods = [('loop', Security.MergePricesIterative), ('bulk', Security.MergePrices)]
+
+        self.stdout.write('Merging {} days of prices:'.format(len(frame)))
+        for case, prefill in cases:
+            for name, fn in methods:
+                elapsed, queries = self.run_case(fn, frame.copy(), prefill)
+                self.stdout.write('{:>14} {:>5}: {:8.3f}s {:6} queries'.format(case, name, elapsed, queries))
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+def forward(apps, schema_editor):
+    # Raw SQL outside the historical models: replaces the securities_cadview materialized view
+    # with the table SecurityPriceDetail.Refresh now upserts into. This drops the financeview_holdingdetail
+    # view that depends on it; finance 0033 recreates that.
+    from securities.models import SecurityPriceDetail
+    SecurityPriceDetail.CreateView(drop_cascading=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('securities', '0011_auto_20180728_2307'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, migrations.RunPython.noop)
+    ]
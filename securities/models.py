@@ -1,21 +1,73 @@
 import datetime
+import time
+import traceback
+from collections import namedtuple
 from decimal import Decimal
 
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import models, transaction, connection
+from django.db.models import Exists, Max, Min, OuterRef, Subquery
 from django.utils import timezone
 from django.utils.functional import cached_property
 from model_utils import Choices
 
 from datasource.models import AlphaVantageStockSource, MorningstarDataSource, InterpolatedDataSource
-from datasource.models import DataSourceMixin, ConstantDataSource, PandasDataSource
+from datasource.models import DataSourceMixin, ConstantDataSource, PandasDataSource, DataSourceCoverage
+from datasource.breaker import SourceError
 from datasource.services import get_data_from_sources
-from utils.db import SecurityMixinQuerySet, DayMixinQuerySet
+from .services import SecuritySyncResult, SyncEngine, print_sync_summary
+from utils.calendars import MAX_CLOSED_DAYS, NYSE, TSX
+from utils.db import SecurityMixinQuerySet, DayMixinQuerySet, drop_relation
+from utils.misc import partition
 
 
 class MissingPriceException(Exception):
     pass
 
+SyncPlanEntry = namedtuple('SyncPlanEntry', ['security', 'start', 'end', 'reason'])
+
+
+def live_price_day():
+    """ The last day we need a price for, for anything still held."""
+    # At 12:01 we no longer have prices for the current day and everything breaks.
+    # "Fix" this by requesting tomorrow's data 10 minutes early. The datasource fills
+    # the price list forward to the requested date.
+    now = datetime.datetime.now()
+    if now.hour == 23 and now.minute >= 49:
+        return datetime.date.today() + datetime.timedelta(days=1)
+    return datetime.date.today()
+
+
+def price_range_needed(first_activity, last_activity, is_held):
+    """
+    :return: The (earliest, latest) days we need prices for, given the first and last
+             activity dates (or None) and whether anyone currently holds the security.
+    """
+    earliest = first_activity or datetime.date.today()
+    if not last_activity or is_held:
+        return earliest, live_price_day()
+    return earliest, last_activity
+
+
+def plan_sync_range(earliest_have, latest_have, earliest_needed, latest_needed, force_today, calendar=None):
+    """
+    :param calendar: A TradingCalendar. Only days it is open on need prices of their own.
+    :return: A (start, end, reason) triple of what needs to be synced. (None, None, None) if nothing.
+    """
+    if calendar is not None:
+        earliest_needed = calendar.previous_open(earliest_needed)
+        latest_needed = calendar.previous_open(latest_needed)
+
+    if earliest_have is None:
+        return earliest_needed, latest_needed, 'no prices'
+    if earliest_have >= earliest_needed:
+        return earliest_needed, latest_needed, 'missing history'
+    if latest_have < latest_needed:
+        return latest_have, latest_needed, 'out of date'
+    if force_today and latest_needed == datetime.date.today():
+        return latest_needed, latest_needed, 'live update'
+    return None, None, None
+
+
 class SecurityQuerySet(models.QuerySet):
     def create(self, **kwargs):
         kwargs.setdefault('type', self.model.Type.Stock if len(kwargs['symbol']) < 20 else self.model.Type.Option)
@@ -25,19 +77,106 @@ class SecurityQuerySet(models.QuerySet):
         obj.set_default_datasources()
         return obj
 
+    def _related_aggregate(self, relation, aggregate, field):
+        related = self.model._meta.get_field(relation)
+        fk = related.field.name
+        return Subquery(related.related_model.objects.filter(**{fk: OuterRef('pk')}).order_by().values(
+            fk).annotate(value=aggregate(field)).values('value'))
+
+    def with_sync_ranges(self):
+        """
+        Annotates each security with the range of prices we have (earliest_have, latest_have),
+        its first and last activity dates, and whether it is currently held (is_held).
+        Each is a correlated subquery, so this is still a single query.
+        """
+        holding_model = self.model._meta.get_field('holdings').related_model
+        return self.annotate(
+            earliest_have=self._related_aggregate('prices', Min, 'day'),
+            latest_have=self._related_aggregate('prices', Max, 'day'),
+            first_activity=self._related_aggregate('activities', Min, 'trade_date'),
+            last_activity=self._related_aggregate('activities', Max, 'trade_date'),
+            is_held=Exists(holding_model.objects.filter(security=OuterRef('pk'), enddate=None)),
+        )
+
+    def sync_plan(self, force_today=False):
+        """
+        Works out what every security in this QuerySet needs synced, in one query.
+        :return: A list of SyncPlanEntry, only for securities that need syncing.
+        """
+        plan = []
+        for security in self.with_sync_ranges():
+            start, end, reason = security.sync_range(force_today)
+            if start is not None:
+                plan.append(SyncPlanEntry(security, start, end, reason))
+        return plan
+
 
 class SecurityManager(models.Manager):
     def Sync(self, live_update):
         queryset = self.get_queryset()
         if live_update:
             queryset = queryset.filter(holdings__enddate__isnull=True).distinct()
-        for security in queryset:
+        plan = queryset.prefetch_related('datasources').sync_plan(live_update)
+        others, fx = partition(lambda entry: entry.security.uses_bankofcanada, plan)
+        results = self.SyncFxRates(list(fx)) + SyncEngine().Run(list(others), live_update)
+        print_sync_summary(results)
+        return results
+
+    def SyncFxRates(self, plan):
+        """
+        Syncs the exchange rates of many currencies together. Every Bank of Canada series is
+        fetched in one request, and all the new rates are saved in one statement.
+        :param plan: A list of SyncPlanEntry.
+        :return: A list of SecuritySyncResult, one per planned security.
+        """
+        if not plan:
+            return []
+        began = time.perf_counter()
+        start = min(entry.start for entry in plan)
+        end = max(entry.end for entry in plan)
+        synced, error = {}, None
+        try:
             try:
-                security.SyncRates(live_update)
-            except:
-                import traceback
-                print('Encountered exception:')
-                traceback.print_exc()
+                prefetched = PandasDataSource.RetrieveMany(
+                    [ds for entry in plan for ds in entry.security.datasources.all()],
+                    start - datetime.timedelta(days=7), end)
+            except SourceError as e:
+                print('Bulk exchange rate fetch failed, falling back to one at a time: {}'.format(e))
+                prefetched = {}
+
+            rows, fetched = [], {}
+            for entry in plan:
+                security = entry.security
+                fetched[security] = []
+                data = get_data_from_sources(security.datasources.all(), entry.start, entry.end,
+                                             security, fetched[security], prefetched)
+                if data.empty:
+                    latest = security.prices.order_by('day').last()
+                    if latest is None:
+                        continue
+                    first = latest.day + datetime.timedelta(days=1)
+                    rows.extend((security.symbol, day, latest.price, 0)
+                                for day in security.trading_calendar.open_days(first, entry.end))
+                    synced[security.symbol] = (first, entry.end)
+                else:
+                    rows.extend((security.symbol, day, price, priority) for day, price, priority in data.itertuples())
+                    synced[security.symbol] = (data.index[0], entry.end)
+
+            with transaction.atomic():
+                SecurityPrice.objects.bulk_merge(rows)
+                for security, security_fetched in fetched.items():
+                    DataSourceCoverage.objects.record_all(security, security_fetched)
+                if synced:
+                    SecurityPriceDetail.Refresh(list(synced), min(first for first, _ in synced.values()), end)
+                    self.filter(pk__in=list(synced)).update(last_sync_time=timezone.now())
+        except Exception as e:
+            print('Encountered exception syncing exchange rates:')
+            traceback.print_exc()
+            synced, error = {}, e
+
+        seconds = (time.perf_counter() - began) / len(plan)
+        return [SecuritySyncResult(entry.security.symbol, 'bankofcanada', synced.get(entry.security.symbol),
+                                   seconds, error) for entry in plan]
 
 
 class StockSecurityManager(SecurityManager):
@@ -142,21 +281,21 @@ class Security(models.Model):
         return self.symbol < other.symbol
 
     @cached_property
+    def _price_range_needed(self):
+        if not hasattr(self, 'is_held'):
+            # Not annotated by SecurityQuerySet.with_sync_ranges, so look it up.
+            dates = self.activities.aggregate(first=Min('trade_date'), last=Max('trade_date'))
+            self.first_activity, self.last_activity = dates['first'], dates['last']
+            self.is_held = self.holdings.current().exists()
+        return price_range_needed(self.first_activity, self.last_activity, self.is_held)
+
+    @property
     def earliest_price_needed(self):
-        if not self.activities.exists():
-            return datetime.date.today()
-        return self.activities.earliest().trade_date
+        return self._price_range_needed[0]
 
-    @cached_property
+    @property
     def latest_price_needed(self):
-        if not self.activities.exists() or self.holdings.current().exists():
-            # At 12:01 we no longer have prices for the current day and everything breaks.
-            # "Fix" this by requesting tomorrow's data 10 minutes early. The datasource fills
-            # the price list forward to the requested date.
-            if datetime.datetime.now().hour == 23 and datetime.datetime.now().minute >= 49:
-                return datetime.date.today() + datetime.timedelta(days=1)
-            return datetime.date.today()
-        return self.activities.latest().trade_date
+        return self._price_range_needed[1]
 
     @cached_property
     def price_multiplier(self):
@@ -202,22 +341,27 @@ class Security(models.Model):
 
     def GetShouldSyncRange(self, force_today):
         """ Returns a pair (start,end) of datetime.dates that need to be synced."""
-        try:
-            earliest = self.prices.earliest().day
-            latest = self.prices.latest().day
-        except ObjectDoesNotExist:
-            return self.earliest_price_needed, self.latest_price_needed
-
-        if earliest >= self.earliest_price_needed:
-            return self.earliest_price_needed, self.latest_price_needed
+        return self.sync_range(force_today)[:2]
 
-        if latest < self.latest_price_needed:
-            return latest, self.latest_price_needed
+    def sync_range(self, force_today):
+        """ Returns a triple (start, end, reason) of what needs to be synced."""
+        if not hasattr(self, 'earliest_have'):
+            # Not annotated by SecurityQuerySet.with_sync_ranges, so look it up.
+            have = self.prices.aggregate(earliest=Min('day'), latest=Max('day'))
+            self.earliest_have, self.latest_have = have['earliest'], have['latest']
+        return plan_sync_range(self.earliest_have, self.latest_have, self.earliest_price_needed,
+                               self.latest_price_needed, force_today, self.trading_calendar)
 
-        if force_today and self.latest_price_needed == datetime.date.today():
-            return datetime.date.today(), datetime.date.today()
+    @property
+    def uses_bankofcanada(self):
+        return any(ds.provider == 'bankofcanada' for ds in self.datasources.all())
 
-        return None, None
+    @property
+    def trading_calendar(self):
+        # Currencies follow the Bank of Canada, which publishes on Canadian business days.
+        if self.currency == 'USD' and self.type != self.Type.Cash:
+            return NYSE
+        return TSX
 
     @property
     def live_price(self):
@@ -225,7 +369,9 @@ class Security(models.Model):
 
     @live_price.setter
     def live_price(self, value):
-        self.prices.update_or_create(day=datetime.date.today(), defaults={'price': value})
+        today = datetime.date.today()
+        self.prices.update_or_create(day=today, defaults={'price': value})
+        SecurityPriceDetail.Refresh([self.symbol], today, today)
 
     @property
     def live_price_cad(self):
@@ -234,29 +380,63 @@ class Security(models.Model):
     @property
     def yesterday_price(self):
         try:
-            return self.prices.get(day=datetime.date.today() - datetime.timedelta(days=1)).price
-        except SecurityPrice.DoesNotExist:
+            return self.pricedetails.get(day=datetime.date.today() - datetime.timedelta(days=1)).price
+        except SecurityPriceDetail.DoesNotExist:
             return 0
 
-    def SyncRates(self, force_today=False):
-        start, end = self.GetShouldSyncRange(force_today)
+    def SyncRates(self, force_today=False, sync_range=None, prefetched=None):
+        """
+        :param sync_range: The (start, end) to sync, if already planned. Otherwise it is worked out here.
+        :param prefetched: Series already retrieved for some of our datasources, see SyncEngine.Prefetch
+        :return: The (start, end) range of days that was synced, or None if we were up to date.
+        """
+        start, end = sync_range or self.GetShouldSyncRange(force_today)
         if start is None:
-            return []
+            return None
+
+        if not self.prices.exists():
+            # Whatever coverage we have is stale if none of its prices are left.
+            self.coverage.all().delete()
 
-        data = get_data_from_sources(self.datasources.all(), start, end)
+        fetched = []
+        data = get_data_from_sources(self.datasources.all(), start, end, self, fetched, prefetched)
         if data.empty:
             latest = self.prices.latest()
-            day = latest.day + datetime.timedelta(days=1)
-            while day <= end:
-                self.prices.update_or_create(day=day, defaults={'price': latest.price,
-                                                                'priority': 0})
-                day += datetime.timedelta(days=1)
-            return
+            start = latest.day + datetime.timedelta(days=1)
+            with transaction.atomic():
+                SecurityPrice.objects.bulk_merge(
+                    (self.symbol, day, latest.price, 0) for day in self.trading_calendar.open_days(start, end))
+                SecurityPriceDetail.Refresh([self.symbol], start, end)
+                DataSourceCoverage.objects.record_all(self, fetched)
+            return start, end
+
+        # The days after the last price up to end are filled forward by SecurityPriceDetail.
+        with transaction.atomic():
+            self.MergePrices(data)
+            DataSourceCoverage.objects.record_all(self, fetched)
+            SecurityPriceDetail.Refresh([self.symbol], data.index[0], end)
+            self.last_sync_time = timezone.now()
+            self.save(update_fields=['last_sync_time'])
+        return data.index[0], end
 
+    def MergePrices(self, data):
+        """
+        Merges a DataFrame of (price, priority) indexed by day into our stored prices,
+        in a single statement. Existing prices are only replaced when the new priority wins.
+        """
+        for day, price in data.price[data.price < 0.1].items():
+            print('ALERT... UPDATING {} to {}'.format(day, price))
+        return SecurityPrice.objects.bulk_merge(
+            (self.symbol, day, price, priority) for day, price, priority in data.itertuples())
+
+    def MergePricesIterative(self, data):
+        """
+        The row-at-a-time equivalent of MergePrices. Kept around for benchmarking.
+        """
         with transaction.atomic():
             query = self.prices.select_for_update().filter(day__range=(data.index[0], data.index[-1]))
             for p in query:
-                new_price = data.ix[p.day]
+                new_price = data.loc[p.day]
                 if DataSourceMixin.is_higher_priority(p.priority, new_price.priority):
                     if new_price.price < 0.1:
                         print('ALERT... UPDATING {} to {}'.format(p.day, new_price.price))
@@ -267,8 +447,6 @@ class Security(models.Model):
             for series in data.itertuples():
                 self.prices.get_or_create(day=series.Index, defaults={'price': series.price,
                                                                       'priority': series.priority})
-            self.last_sync_time = timezone.now()
-            self.save(update_fields=['last_sync_time'])
 
     def GetTodaysChange(self):
         rates = self.prices.filter(
@@ -316,7 +494,26 @@ class Option(Security):
 class SecurityPriceQuerySet(models.query.QuerySet,
                             SecurityMixinQuerySet,
                             DayMixinQuerySet):
-    pass
+    def bulk_merge(self, rows):
+        """
+        Upserts (security_id, day, price, priority) rows in one INSERT ... ON CONFLICT statement.
+        An existing price is only overwritten if DataSourceMixin.is_higher_priority(old, new).
+        :return: A list of the (security_id, day) pairs that were inserted or updated.
+        """
+        rows = list(rows)
+        if not rows:
+            return []
+        symbols, days, prices, priorities = zip(*rows)
+        with connection.cursor() as cursor:
+            cursor.execute("""
+INSERT INTO securities_securityprice AS old (security_id, day, price, priority)
+SELECT * FROM unnest(%s::varchar[], %s::date[], %s::numeric[], %s::integer[])
+ON CONFLICT (security_id, day) DO UPDATE
+    SET price = EXCLUDED.price, priority = EXCLUDED.priority
+    WHERE EXCLUDED.priority = %s OR EXCLUDED.priority >= old.priority
+RETURNING security_id, day;""", [list(symbols), list(days), [str(p) for p in prices],
+                                 [int(p) for p in priorities], DataSourceMixin.PRIORITY_REALTIME])
+            return cursor.fetchall()
 
 
 class SecurityPrice(models.Model):
@@ -352,43 +549,107 @@ class SecurityPriceDetail(models.Model):
 
     @classmethod
     def CreateView(cls, drop_cascading=False):
-        cursor = connection.cursor()
-        try:
-            cursor.execute(
-                "DROP MATERIALIZED VIEW IF EXISTS securities_cadview {};".format("CASCADE" if drop_cascading else ""))
+        """
+        Creates the securities_cadview table and fills it. It is kept up to date incrementally
+        by Refresh, so this only needs to run when the schema changes.
+        Safe to re-run, and replaces the materialized view this used to be.
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            drop_relation(cursor, 'securities_cadview', cascade=drop_cascading)
             cursor.execute("""
-CREATE MATERIALIZED VIEW public.securities_cadview
-AS
-SELECT prices.symbol as security_id, 
-    prices.day, 
-    prices.price,
-    COALESCE(currencies.price, 1) as exch,
-    prices.price * COALESCE(currencies.price, 1) as cadprice,
-    prices.type,    
-    row_number() OVER () AS id
-    FROM (SELECT s.symbol, 
-     s.currency, 
-     p.day, 
-     p.price,
-     s.type 
-     FROM securities_security s 
-        JOIN securities_securityprice p ON s.symbol=p.security_id) prices
-        LEFT JOIN securities_securityprice currencies on prices.day=currencies.day and currencies.security_id=prices.currency
-WITH DATA;
+CREATE TABLE securities_cadview (
+    id serial PRIMARY KEY,
+    security_id varchar(32) NOT NULL,
+    day date NOT NULL,
+    price numeric(16, 6) NOT NULL,
+    exch numeric(16, 6) NOT NULL,
+    cadprice numeric(16, 6) NOT NULL,
+    type varchar(12) NOT NULL,
+    UNIQUE (security_id, day)
+);
+CREATE INDEX securities_cadview_day ON securities_cadview (day);
 ALTER TABLE securities_cadview OWNER TO financeuser;
 """)
-            connection.commit()
-        finally:
-            cursor.close()
+            cls.Refresh()
 
     @classmethod
-    def Refresh(cls):
-        cursor = connection.cursor()
-        try:
-            cursor.execute("REFRESH MATERIALIZED VIEW securities_cadview;")
-            connection.commit()
-        finally:
-            cursor.close()
+    def Refresh(cls, securities=None, start=None, end=None):
+        """
+        Recomputes the CAD prices of the given securities between start and end inclusive.
+        If a currency is in securities, every security priced in that currency is recomputed too.
+        With no arguments, everything is recomputed.
+        Prices are only stored for trading days, so each day takes the latest price and exchange
+        rate on or before it. The days after end that were filled forward from it are recomputed too.
+        :param securities: An iterable of symbols, or None for all securities.
+        :param start: A datetime.date, or None for no lower bound.
+        :param end: A datetime.date, or None for no upper bound.
+        """
+        conditions, params = ['TRUE'], {}
+        if securities is not None:
+            conditions.append('(s.symbol = ANY(%(symbols)s) OR s.currency = ANY(%(symbols)s))')
+            params['symbols'] = list(securities)
+        if start:
+            conditions.append('{day} >= %(start)s')
+            params['start'] = start
+        if end:
+            conditions.append('{day} <= %(end)s')
+            params['end'] = end + datetime.timedelta(days=MAX_CLOSED_DAYS)
+        where = ' AND '.join(conditions)
+        params['fill_days'] = MAX_CLOSED_DAYS
+        params['through'] = live_price_day()
+
+        # Like REFRESH MATERIALIZED VIEW CONCURRENTLY: compute the fresh rows, upsert the ones
+        # that changed and delete the ones that are gone, all in one statement. Readers are
+        # never blocked, unchanged rows keep their id, and overlapping refreshes can't collide.
+        with connection.cursor() as cursor:
+            cursor.execute("""
+WITH fresh AS (
+    SELECT s.symbol AS security_id,
+        d.day,
+        p.price,
+        COALESCE(fx.price, 1) AS exch,
+        p.price * COALESCE(fx.price, 1) AS cadprice,
+        s.type
+        FROM securities_security s
+            CROSS JOIN LATERAL (
+                SELECT min(day) AS first, max(day) AS last FROM securities_securityprice
+                    WHERE security_id = s.symbol) r
+            -- Every day from the first price, filled forward a few days past the last one but not past today.
+            CROSS JOIN LATERAL (
+                SELECT generate_series(r.first, GREATEST(r.last, LEAST(r.last + %(fill_days)s, %(through)s)),
+                                       interval '1 day')::date AS day) d
+            CROSS JOIN LATERAL (
+                SELECT price FROM securities_securityprice
+                    WHERE security_id = s.symbol AND day <= d.day ORDER BY day DESC LIMIT 1) p
+            LEFT JOIN LATERAL (
+                SELECT price FROM securities_securityprice
+                    WHERE security_id = s.currency AND day <= d.day ORDER BY day DESC LIMIT 1) fx ON TRUE
+        WHERE {fresh}
+), upserted AS (
+    INSERT INTO securities_cadview AS c (security_id, day, price, exch, cadprice, type)
+    SELECT * FROM fresh
+    ON CONFLICT (security_id, day) DO UPDATE
+        SET price = EXCLUDED.price, exch = EXCLUDED.exch, cadprice = EXCLUDED.cadprice, type = EXCLUDED.type
+        WHERE (c.price, c.exch, c.cadprice, c.type) IS DISTINCT FROM
+            (EXCLUDED.price, EXCLUDED.exch, EXCLUDED.cadprice, EXCLUDED.type)
+)
+DELETE FROM securities_cadview c
+    USING securities_security s
+    WHERE c.security_id = s.symbol AND {stale}
+        AND NOT EXISTS (SELECT 1 FROM fresh f WHERE f.security_id = c.security_id AND f.day = c.day);
+""".format(fresh=where.format(day='d.day'), stale=where.format(day='c.day')), params)
+
+    @classmethod
+    def FillForward(cls):
+        """
+        Carries every security's latest prices forward to live_price_day(). Refresh only fills
+        forward as far as the day it runs, and on weekends and holidays nothing is synced to
+        trigger one, so this needs to run every day regardless of what was synced.
+        :return: The first day that was recomputed.
+        """
+        start = live_price_day() - datetime.timedelta(days=MAX_CLOSED_DAYS)
+        cls.Refresh(start=start)
+        return start
 
     class Meta:
         managed = False
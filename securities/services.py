@@ -0,0 +1,186 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from datetime import timedelta
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+from datasource.breaker import CircuitBreaker
+from datasource.throttle import Throttled, nonblocking
+
+# How many securities of each provider may sync at the same time.
+# Providers not listed here get DEFAULT_CONCURRENCY.
+PROVIDER_CONCURRENCY = {
+    'alphavantage': 1,
+    'grs': 1,
+    'questrade': 2,
+    'morningstar': 4,
+    'bankofcanada': 4,
+}
+DEFAULT_CONCURRENCY = 4
+MAX_WORKERS = 8
+
+
+SecuritySyncResult = namedtuple('SecuritySyncResult', ['symbol', 'lane', 'synced', 'seconds', 'error'])
+
+
+class SyncSchedule:
+    """
+    The queue of securities waiting to sync, shared by all the worker threads.
+    Hands out the earliest ready security whose lane still has capacity.
+    """
+
+    def __init__(self, concurrency_fn):
+        self.concurrency_fn = concurrency_fn
+        self.heap = []
+        self.running = Counter()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def push(self, lane, entry, ready_at=0):
+        with self.condition:
+            heapq.heappush(self.heap, (ready_at, next(self.sequence), lane, entry))
+            self.condition.notify_all()
+
+    def pop(self):
+        """
+        :return: The next (lane, entry) to sync, blocking until one is ready.
+                 None once there is nothing left to do.
+        """
+        with self.condition:
+            while True:
+                if not self.heap and not sum(self.running.values()):
+                    return None
+                now = time.monotonic()
+                for entry in sorted(self.heap):
+                    ready_at, _, lane, item = entry
+                    if ready_at > now:
+                        break
+                    if self.running[lane] < self.concurrency_fn(lane):
+                        self.heap.remove(entry)
+                        heapq.heapify(self.heap)
+                        self.running[lane] += 1
+                        return lane, item
+                waits = [ready_at - now for ready_at, *_ in self.heap if ready_at > now]
+                self.condition.wait(min(waits) if waits else None)
+
+    def done(self, lane):
+        with self.condition:
+            self.running[lane] -= 1
+            self.condition.notify_all()
+
+
+class SyncEngine:
+    """
+    Syncs the prices of many securities at once on a thread pool.
+
+    Each security is put in the lane of its most restrictive provider, and each lane only runs
+    as many securities concurrently as that provider allows. Rate limited calls don't sleep: the
+    security goes back in the queue until its provider has budget again, and the worker moves on
+    to another security. An exception only fails its own security.
+    """
+
+    def __init__(self, concurrency=None, max_workers=MAX_WORKERS):
+        self.concurrency = dict(PROVIDER_CONCURRENCY, **(concurrency or {}))
+        self.max_workers = max_workers
+
+    def lane_concurrency(self, lane):
+        return self.concurrency.get(lane, DEFAULT_CONCURRENCY)
+
+    def get_lane(self, security):
+        providers = {ds.provider for ds in security.datasources.all() if ds.provider}
+        return min(providers, key=self.lane_concurrency, default='')
+
+    def Run(self, plan, force_today=False):
+        """
+        :param plan: A list of SyncPlanEntry, from SecurityQuerySet.sync_plan
+        :param force_today: Passed through to Security.SyncRates
+        :return: A list of SecuritySyncResult, one per planned security.
+        """
+        prefetched = self.Prefetch(plan)
+        schedule = SyncSchedule(self.lane_concurrency)
+        lanes = Counter()
+        for entry in plan:
+            lane = self.get_lane(entry.security)
+            lanes[lane] += 1
+            schedule.push(lane, entry)
+
+        workers = min(self.max_workers, sum(min(self.lane_concurrency(l), n) for l, n in lanes.items()))
+        if not workers:
+            return []
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._Work, schedule, force_today, prefetched) for _ in range(workers)]
+            return [result for future in futures for result in future.result()]
+
+    def Prefetch(self, plan):
+        """
+        Lets each type of datasource retrieve all of its sources in the plan at once, where it can.
+        :return: A dict of source pk -> pandas.Series, for get_data_from_sources.
+        """
+        if not plan:
+            return {}
+        start = min(entry.start for entry in plan) - timedelta(days=7)
+        end = max(entry.end for entry in plan)
+        by_type = defaultdict(dict)
+        for entry in plan:
+            for source in entry.security.datasources.all():
+                by_type[type(source)][source.pk] = source
+
+        prefetched = {}
+        for source_type, sources in by_type.items():
+            try:
+                prefetched.update(source_type.RetrieveMany(list(sources.values()), start, end))
+            except Exception:
+                print('Encountered exception prefetching {}:'.format(source_type.__name__))
+                traceback.print_exc()
+        return prefetched
+
+    def _Work(self, schedule, force_today, prefetched):
+        results = []
+        try:
+            while True:
+                item = schedule.pop()
+                if item is None:
+                    return results
+                lane, entry = item
+                try:
+                    results.append(self._SyncSecurity(lane, entry, force_today, prefetched))
+                except Throttled as e:
+                    schedule.push(lane, entry, time.monotonic() + e.retry_after)
+                finally:
+                    schedule.done(lane)
+        finally:
+            # Each worker thread has its own DB connection, don't leak it.
+            connection.close()
+
+    def _SyncSecurity(self, lane, entry, force_today, prefetched):
+        security = entry.security
+        start = time.perf_counter()
+        synced = error = None
+        try:
+            with nonblocking():
+                synced = security.SyncRates(force_today, (entry.start, entry.end), prefetched)
+        except Throttled:
+            raise
+        except Exception as e:
+            print('Encountered exception syncing {}:'.format(security))
+            traceback.print_exc()
+            error = e
+        return SecuritySyncResult(security.symbol, lane, synced, time.perf_counter() - start, error)
+
+
+def print_sync_summary(results):
+    for result in sorted(results, key=lambda r: r.seconds, reverse=True):
+        print('{:<24} {:<14} {:7.2f}s {}'.format(result.symbol, result.lane or 'local', result.seconds,
+                                                 'FAILED: {!r}'.format(result.error) if result.error else
+                                                 result.synced or 'up to date'))
+    failed = sum(1 for r in results if r.error)
+    print('Synced {} securities, {} failed.'.format(len(results) - failed, failed))
+    for lane in sorted({r.lane for r in results if r.lane}):
+        print('{:<14} circuit {state:<9} {calls} calls, {errors} errors, {error_rate:.0%} recent errors, '
+              '{mean_latency:.2f}s mean / {max_latency:.2f}s max latency'.format(lane, **CircuitBreaker(lane).stats()))
@@ -1 +1,141 @@
-# Create your tests here.
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from datasource.models import DataSourceMixin
+from utils.calendars import MAX_CLOSED_DAYS, NYSE, TSX
+from .models import Security, SecurityPrice, SecurityPriceDetail, live_price_day, plan_sync_range
+
+
+class SecurityPriceMergeTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.security = Security(symbol='TEST', currency='CAD')
+        cls.security.save()
+        cls.security.prices.create(day=date(2018, 1, 1), price=10, priority=DataSourceMixin.PRIORITY_DAILY)
+
+    def test_merge_inserts_new_days(self):
+        SecurityPrice.objects.bulk_merge([('TEST', date(2018, 1, 2), 11, DataSourceMixin.PRIORITY_DAILY)])
+        self.assertEqual(self.security.prices.get(day=date(2018, 1, 2)).price, 11)
+
+    def test_merge_keeps_higher_priority(self):
+        SecurityPrice.objects.bulk_merge([('TEST', date(2018, 1, 1), 12, DataSourceMixin.PRIORITY_LOW)])
+        self.assertEqual(self.security.prices.get(day=date(2018, 1, 1)).price, 10)
+
+    def test_merge_replaces_equal_priority(self):
+        SecurityPrice.objects.bulk_merge([('TEST', date(2018, 1, 1), Decimal('12.5'), DataSourceMixin.PRIORITY_DAILY)])
+        self.assertEqual(self.security.prices.get(day=date(2018, 1, 1)).price, Decimal('12.5'))
+
+    def test_merge_realtime_always_wins(self):
+        self.security.prices.filter(day=date(2018, 1, 1)).update(priority=99)
+        SecurityPrice.objects.bulk_merge([('TEST', date(2018, 1, 1), 13, DataSourceMixin.PRIORITY_REALTIME)])
+        self.assertEqual(self.security.prices.get(day=date(2018, 1, 1)).price, 13)
+
+
+class SecurityPriceDetailRefreshTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.usd = Security(symbol='USD', type=Security.Type.Cash, currency='CAD')
+        cls.usd.save()
+        cls.stock = Security(symbol='TEST', currency='USD')
+        cls.stock.save()
+        cls.usd.prices.create(day=date(2018, 1, 1), price=Decimal('1.25'))
+        cls.stock.prices.create(day=date(2018, 1, 1), price=10)
+        SecurityPriceDetail.CreateView()
+
+    def test_create_view(self):
+        detail = self.stock.pricedetails.get(day=date(2018, 1, 1))
+        self.assertEqual(detail.exch, Decimal('1.25'))
+        self.assertEqual(detail.cadprice, Decimal('12.5'))
+
+    def test_create_view_twice(self):
+        SecurityPriceDetail.CreateView()
+        self.assertEqual(self.stock.pricedetails.get(day=date(2018, 1, 1)).cadprice, Decimal('12.5'))
+
+    def test_refresh_security(self):
+        self.stock.prices.create(day=date(2018, 1, 2), price=20)
+        SecurityPriceDetail.Refresh(['TEST'], date(2018, 1, 2), date(2018, 1, 2))
+        self.assertEqual(self.stock.pricedetails.get(day=date(2018, 1, 2)).cadprice, 20)
+        self.assertEqual(self.stock.pricedetails.filter(day__lte=date(2018, 1, 2)).count(), 2)
+
+    def test_refresh_fills_forward_over_closed_days(self):
+        # Friday's prices carry over the weekend.
+        self.stock.prices.create(day=date(2018, 1, 5), price=20)
+        self.usd.prices.create(day=date(2018, 1, 4), price=Decimal('1.5'))
+        SecurityPriceDetail.Refresh(['TEST', 'USD'], date(2018, 1, 4), date(2018, 1, 5))
+        self.assertEqual(self.stock.pricedetails.get(day=date(2018, 1, 3)).cadprice, Decimal('12.5'))
+        self.assertEqual(self.stock.pricedetails.get(day=date(2018, 1, 7)).cadprice, 30)
+        self.assertEqual(self.stock.pricedetails.latest().day, date(2018, 1, 5) + timedelta(days=MAX_CLOSED_DAYS))
+
+    def test_fill_forward_to_saturday(self):
+        # Friday's price was refreshed on Friday, and no exchange is open on Saturday to sync.
+        self.stock.prices.create(day=date(2018, 1, 5), price=20)
+        with mock.patch('securities.models.live_price_day', return_value=date(2018, 1, 5)):
+            SecurityPriceDetail.Refresh(['TEST'], date(2018, 1, 5), date(2018, 1, 5))
+        self.assertFalse(self.stock.pricedetails.filter(day=date(2018, 1, 6)).exists())
+
+        with mock.patch('securities.models.live_price_day', return_value=date(2018, 1, 6)):
+            SecurityPriceDetail.FillForward()
+        self.assertEqual(self.stock.pricedetails.get(day=date(2018, 1, 6)).cadprice, 25)
+        self.assertEqual(self.stock.pricedetails.latest().day, date(2018, 1, 6))
+
+    def test_refresh_currency_updates_dependents(self):
+        self.usd.prices.filter(day=date(2018, 1, 1)).update(price=Decimal('1.5'))
+        SecurityPriceDetail.Refresh(['USD'], date(2018, 1, 1), date(2018, 1, 1))
+        self.assertEqual(self.stock.pricedetails.get(day=date(2018, 1, 1)).cadprice, 15)
+
+
+class SyncPlanTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.empty = Security.objects.create(symbol='EMPTY', currency='CAD')
+        cls.stale = Security.objects.create(symbol='STALE', currency='CAD')
+        cls.stale.prices.create(day=date(2018, 1, 1), price=10)
+        cls.current = Security.objects.create(symbol='CURRENT', currency='CAD')
+        cls.current.prices.create(day=date(2017, 12, 1), price=10)
+        cls.current.prices.create(day=live_price_day(), price=10)
+
+    def test_plan_matches_per_security_ranges(self):
+        plan = {entry.security.symbol: entry for entry in Security.objects.all().sync_plan()}
+        for security in Security.objects.all():
+            start, end = security.GetShouldSyncRange(False)
+            if start is None:
+                self.assertNotIn(security.symbol, plan)
+            else:
+                self.assertEqual((plan[security.symbol].start, plan[security.symbol].end), (start, end))
+
+    def test_plan_reasons(self):
+        plan = {entry.security.symbol: entry for entry in Security.objects.all().sync_plan()}
+        self.assertEqual(plan['EMPTY'].reason, 'no prices')
+        self.assertEqual(plan['STALE'].reason, 'out of date')
+        self.assertNotIn('CURRENT', plan)
+
+    def test_plan_is_one_query(self):
+        with self.assertNumQueries(1):
+            Security.objects.all().sync_plan()
+
+
+class TradingCalendarTestCase(SimpleTestCase):
+    def test_tsx_holidays(self):
+        self.assertFalse(TSX.is_open(date(2018, 5, 21)))  # Victoria Day
+        self.assertFalse(TSX.is_open(date(2021, 12, 28)))  # Boxing Day, moved past Christmas on a Saturday
+        self.assertTrue(TSX.is_open(date(2018, 7, 4)))
+
+    def test_nyse_holidays(self):
+        self.assertFalse(NYSE.is_open(date(2018, 11, 22)))  # Thanksgiving
+        self.assertFalse(NYSE.is_open(date(2021, 12, 24)))  # Christmas on a Saturday
+        self.assertTrue(NYSE.is_open(date(2022, 12, 30)))  # New Year's on a Saturday isn't moved back
+
+    def test_previous_open(self):
+        self.assertEqual(TSX.previous_open(date(2018, 4, 1)), date(2018, 3, 29))  # Easter Sunday
+        self.assertEqual(TSX.previous_open(date(2018, 4, 3)), date(2018, 4, 3))
+
+    def test_planner_skips_closed_days(self):
+        start, end, reason = plan_sync_range(date(2017, 1, 1), date(2018, 3, 29), date(2018, 1, 1),
+                                             date(2018, 4, 1), False, TSX)
+        self.assertIsNone(reason)
@@ -124,10 +124,13 @@ class TangerineAccount(BaseAccount):
     def cur_balance(self):
         return self.account_balance
 
-    def CreateActivities(self, start, end):
+    def FetchActivities(self, start, end):
         with self.client as client:
-            for trans in client.GetActivities(self.account_id, start, end):
-                TangerineRawActivity.objects.get_or_create(account=self, activity_id=trans['id'],
+            return list(client.GetActivities(self.account_id, start, end))
+
+    def SaveActivities(self, fetched):
+        for trans in fetched:
+            TangerineRawActivity.objects.get_or_create(account=self, activity_id=trans['id'],
                                        defaults={
                                            'day': parser.parse(trans['transaction_date']).date(),
                                            'description': trans['description'],
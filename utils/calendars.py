@@ -0,0 +1,129 @@
+"""
+Exchange trading calendars, computed from the holiday rules so they work offline for any year.
+
+    TSX.is_open(day)
+    NYSE.open_days(start, end)
+"""
+import datetime
+import functools
+
+import numpy
+from dateutil.easter import easter
+
+# The most days in a row an exchange is closed (Christmas on a Saturday closes the TSX Saturday
+# through Tuesday), plus some slack. A price is never filled forward further than this.
+MAX_CLOSED_DAYS = 6
+
+MON, TUE, WED, THU, FRI, SAT, SUN = range(7)
+
+
+def nth_weekday(year, month, weekday, n):
+    """ The nth (1-based) given weekday of the month, or the last one if n is -1."""
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def weekend_to_monday(day):
+    if day.weekday() >= SAT:
+        return day + datetime.timedelta(days=7 - day.weekday())
+    return day
+
+
+def weekend_to_nearest(day):
+    if day.weekday() == SAT:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == SUN:
+        return day + datetime.timedelta(days=1)
+    return day
+
+
+def tsx_holidays(year):
+    holidays = {
+        weekend_to_monday(datetime.date(year, 1, 1)),
+        easter(year) - datetime.timedelta(days=2),
+        # Victoria Day is the last Monday before May 25th.
+        datetime.date(year, 5, 24) - datetime.timedelta(days=datetime.date(year, 5, 24).weekday()),
+        weekend_to_monday(datetime.date(year, 7, 1)),
+        nth_weekday(year, 8, MON, 1),
+        nth_weekday(year, 9, MON, 1),
+        nth_weekday(year, 10, MON, 2),
+    }
+    if year >= 2008:
+        holidays.add(nth_weekday(year, 2, MON, 3))
+
+    # Christmas and Boxing Day both roll forward past a weekend, and past each other.
+    christmas = datetime.date(year, 12, 25)
+    if christmas.weekday() == SAT:
+        holidays.update({datetime.date(year, 12, 27), datetime.date(year, 12, 28)})
+    elif christmas.weekday() == SUN:
+        holidays.update({datetime.date(year, 12, 26), datetime.date(year, 12, 27)})
+    elif christmas.weekday() == FRI:
+        holidays.update({christmas, datetime.date(year, 12, 28)})
+    else:
+        holidays.update({christmas, datetime.date(year, 12, 26)})
+    return holidays
+
+
+def nyse_holidays(year):
+    holidays = {
+        nth_weekday(year, 2, MON, 3),
+        easter(year) - datetime.timedelta(days=2),
+        nth_weekday(year, 5, MON, -1),
+        weekend_to_nearest(datetime.date(year, 7, 4)),
+        nth_weekday(year, 9, MON, 1),
+        nth_weekday(year, 11, THU, 4),
+        weekend_to_nearest(datetime.date(year, 12, 25)),
+    }
+    # New Year's Day on a Saturday isn't moved back into the old year.
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() != SAT:
+        holidays.add(weekend_to_monday(new_year))
+    if year >= 1998:
+        holidays.add(nth_weekday(year, 1, MON, 3))
+    if year >= 2022:
+        holidays.add(weekend_to_nearest(datetime.date(year, 6, 19)))
+    return holidays
+
+
+class TradingCalendar:
+    def __init__(self, name, holiday_fn):
+        self.name = name
+        self.holiday_fn = holiday_fn
+
+    def __repr__(self):
+        return 'TradingCalendar<{}>'.format(self.name)
+
+    @functools.lru_cache(maxsize=None)
+    def holidays(self, year):
+        return frozenset(self.holiday_fn(year))
+
+    def is_open(self, day):
+        return day.weekday() < SAT and day not in self.holidays(day.year)
+
+    def previous_open(self, day):
+        """ The last day on or before day that the exchange is open."""
+        while not self.is_open(day):
+            day -= datetime.timedelta(days=1)
+        return day
+
+    def open_days(self, start, end):
+        days = (start + datetime.timedelta(days=n) for n in range((end - start).days + 1))
+        return [day for day in days if self.is_open(day)]
+
+    def open_mask(self, days):
+        """
+        :param days: A numpy array of datetime64[D].
+        :return: A boolean array, True where the exchange is open.
+        """
+        if not len(days):
+            return numpy.zeros(0, dtype=bool)
+        first, last = days.min().astype(object), days.max().astype(object)
+        holidays = sorted(day for year in range(first.year, last.year + 1) for day in self.holidays(year))
+        return numpy.is_busday(days, holidays=numpy.array(holidays, dtype='datetime64[D]'))
+
+
+TSX = TradingCalendar('TSX', tsx_holidays)
+NYSE = TradingCalendar('NYSE', nyse_holidays)
@@ -1,5 +1,18 @@
 from datetime import date, timedelta
 
+# DROP statements for each pg_class.relkind, since DROP TABLE and DROP MATERIALIZED VIEW refuse each other's kind.
+DROP_BY_RELKIND = {'r': 'TABLE', 'p': 'TABLE', 'v': 'VIEW', 'm': 'MATERIALIZED VIEW'}
+
+
+def drop_relation(cursor, name, cascade=False):
+    """
+    Drops the table, view or materialized view called name, whichever it is, if it exists.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", [name])
+    row = cursor.fetchone()
+    if row:
+        cursor.execute("DROP {} {} {};".format(DROP_BY_RELKIND[row[0]], name, "CASCADE" if cascade else ""))
+
 
 class SecurityMixinQuerySet:
     def for_security(self, symbol):
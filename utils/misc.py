@@ -1,6 +1,9 @@
 import bisect
+import math
 from itertools import tee, filterfalse
 
+import numpy
+
 
 def find_le(a, x, default=None):
     i = bisect.bisect_right(a, x)
@@ -85,6 +88,144 @@ def xnpv(rate, cashflows):
     return sum([float(cf) / (1 + rate) ** ((t - t0).days / 365.0) for t, cf in chron_order])
 
 
+def xirr_secant(cashflows, guess=0.1):
+    """
+    The original scalar XIRR, solved with the secant method over xnpv.
+    It doesn't detect a missing solution, so it's only kept to benchmark xirr_batch against.
+    """
+    cashflows = list(cashflows)
+    return secant_method(0.0001, lambda r: xnpv(r, cashflows), guess)
+
+
+def year_fractions(cashflow_sets):
+    """
+    :param cashflow_sets: A list of lists of (date, amount) cashflows.
+    :return: Two float arrays of shape (sets, longest set): the time in years of each cashflow since
+             the first cashflow of its set, and the amounts. Shorter sets are padded with zero amounts.
+    """
+    times = numpy.zeros((len(cashflow_sets), max(map(len, cashflow_sets), default=0)))
+    amounts = numpy.zeros_like(times)
+    for i, cashflows in enumerate(cashflow_sets):
+        if not cashflows:
+            continue
+        dates, values = zip(*cashflows)
+        days = numpy.array(dates, dtype='datetime64[D]')
+        times[i, :len(days)] = (days - days.min()).astype(float) / 365.0
+        amounts[i, :len(days)] = [float(v) for v in values]
+    return times, amounts
+
+
+def xnpv_batch(rates, times, amounts):
+    """
+    :return: The NPV of each row of cashflows at its rate, and the derivative of the NPV by the rate.
+    """
+    discount = numpy.exp(-times * numpy.log1p(rates)[:, None])
+    npv = (amounts * discount).sum(axis=1)
+    dnpv = -(times * amounts * discount).sum(axis=1) / (1 + rates)
+    return npv, dnpv
+
+
+# Rates to try, in order, when looking for a sign change of the NPV to start Brent's method from.
+BRACKET_RATES = [-0.9999, -0.99, -0.9, -0.5, -0.2, 0, 0.2, 0.5, 1, 2, 5, 10, 100, 1000]
+
+
+def brent(f, a, b, tol=1e-12, max_iter=100):
+    """
+    Finds a root of f between a and b with Brent's method. f(a) and f(b) must have opposite signs.
+    :return: (root, converged)
+    """
+    fa, fb = f(a), f(b)
+    if fa * fb > 0:
+        return math.nan, False
+    c, fc = b, fb
+    d = e = b - a
+    for _ in range(max_iter):
+        if (fb > 0 and fc > 0) or (fb < 0 and fc < 0):
+            c, fc = a, fa
+            d = e = b - a
+        if abs(fc) < abs(fb):
+            a, b, c = b, c, b
+            fa, fb, fc = fb, fc, fb
+        tol1 = 2 * numpy.finfo(float).eps * abs(b) + tol / 2
+        xm = (c - b) / 2
+        if abs(xm) <= tol1 or fb == 0:
+            return b, True
+        if abs(e) >= tol1 and abs(fa) > abs(fb):
+            # Try inverse quadratic interpolation, or the secant step if we only have two points.
+            s = fb / fa
+            if a == c:
+                p, q = 2 * xm * s, 1 - s
+            else:
+                q, r = fa / fc, fb / fc
+                p = s * (2 * xm * q * (q - r) - (b - a) * (r - 1))
+                q = (q - 1) * (r - 1) * (s - 1)
+            if p > 0:
+                q = -q
+            p = abs(p)
+            if 2 * p < min(3 * xm * q - abs(tol1 * q), abs(e * q)):
+                e, d = d, p / q
+            else:
+                d = e = xm
+        else:
+            d = e = xm
+        a, fa = b, fb
+        b += d if abs(d) > tol1 else math.copysign(tol1, xm)
+        fb = f(b)
+    return b, False
+
+
+def xirr_batch(cashflow_sets, guess=0.1, tol=1e-9, max_iter=50):
+    """
+    Solves the XIRR of many sets of cashflows at once.
+
+    Every set takes vectorized Newton steps together. Any set where Newton leaves the domain,
+    stalls or runs out of iterations is then solved on its own with Brent's method, which can't
+    diverge once it has bracketed a root.
+
+    :param cashflow_sets: A list of lists of (date, amount) cashflows, in any order.
+    :param guess: The starting rate for every set.
+    :param tol: Relative tolerance on the rate.
+    :return: (rates, converged) numpy arrays, one entry per set. Rates are NaN where no solution was found.
+    """
+    cashflow_sets = [list(cashflows) for cashflows in cashflow_sets]
+    times, amounts = year_fractions(cashflow_sets)
+    rates = numpy.full(len(cashflow_sets), guess, dtype=float)
+    converged = numpy.zeros(len(cashflow_sets), dtype=bool)
+    # There's no rate of return without money both going in and coming out.
+    solvable = (amounts > 0).any(axis=1) & (amounts < 0).any(axis=1)
+    rates[~solvable] = math.nan
+    active = solvable.copy()
+
+    with numpy.errstate(all='ignore'):
+        for _ in range(max_iter):
+            rows = numpy.flatnonzero(active)
+            if not len(rows):
+                break
+            npv, dnpv = xnpv_batch(rates[rows], times[rows], amounts[rows])
+            step = npv / dnpv
+            new_rates = rates[rows] - step
+            diverged = ~numpy.isfinite(new_rates) | (new_rates <= -1)
+            done = ~diverged & (numpy.abs(step) <= tol * (1 + numpy.abs(new_rates)))
+            rates[rows[~diverged]] = new_rates[~diverged]
+            converged[rows[done]] = True
+            active[rows[done | diverged]] = False
+
+        for i in numpy.flatnonzero(solvable & ~converged):
+            row_times, row_amounts = times[i:i + 1], amounts[i:i + 1]
+
+            def npv(rate):
+                return xnpv_batch(numpy.array([rate]), row_times, row_amounts)[0][0]
+
+            values = [npv(rate) for rate in BRACKET_RATES]
+            brackets = [(lo, hi) for (lo, f_lo), (hi, f_hi) in window(list(zip(BRACKET_RATES, values)))
+                        if numpy.isfinite(f_lo) and numpy.isfinite(f_hi) and f_lo * f_hi <= 0]
+            # Prefer the root nearest the guess, in case there's more than one.
+            brackets.sort(key=lambda bracket: abs(sum(bracket) / 2 - guess))
+            rates[i], converged[i] = brent(npv, *brackets[0], tol=tol) if brackets else (math.nan, False)
+
+    return rates, converged
+
+
 def xirr(cashflows, guess=0.1):
     """
     Calculate the Internal Rate of Return of a series of cashflows at irregular intervals.
@@ -98,13 +239,15 @@ def xirr(cashflows, guess=0.1):
 
     Notes
     ----------------
-    * The Internal Rate of Return (IRR) is the discount rate at which the Net Present Value (NPV) of a series of cash flows is equal to zero. The NPV of the series of cash flows is determined using the xnpv function in this module. The discount rate at which NPV equals zero is found using the secant method of numerical solution.
+    * The Internal Rate of Return (IRR) is the discount rate at which the Net Present Value (NPV) of a series of cash flows is equal to zero. It is solved by xirr_batch; use that directly to solve many series at once.
     * This function is equivalent to the Microsoft Excel function of the same name.
-    * For users that do not have the scipy module installed, there is an alternate version (commented out) that uses the secant_method function defined in the module rather than the scipy.optimize module's numerical solver. Both use the same method of calculation so there should be no difference in performance, but the secant_method function does not fail gracefully in cases where there is no solution, so the scipy.optimize.newton version is preferred.
+    * Raises ValueError if there is no solution.
     """
-    cashflows = list(cashflows)
-    return secant_method(0.0001,lambda r: xnpv(r,cashflows),guess)
-    #return optimize.newton(lambda r: xnpv(r, cashflows), guess)
+    rates, converged = xirr_batch([cashflows], guess)
+    if not converged[0]:
+        raise ValueError('XIRR did not converge')
+    return float(rates[0])
+
 
 def total_return(cashflows):
     cashflows = list(cashflows)